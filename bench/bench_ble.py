@@ -0,0 +1,322 @@
+"""Host-side benchmark of the BLE advertisement decode path
+
+Runs the real GenericBLE dispatch, queue, decryption and record decoding on
+CPython with the stand-in modules in bench/fakes, and reports packets per
+second, per stage latency and allocations per packet.
+
+    python bench/bench_ble.py
+    python bench/bench_ble.py --packets 50000 --save bench/baseline.json
+    python bench/bench_ble.py --check bench/baseline.json --tolerance 0.25
+
+A recorded stream can be fed instead of the synthetic one with --stream, a
+text file with one "mac adv_type rssi payload" line per advertisement (hex
+mac and payload), together with --devices, a JSON list of
+{"mac": hex, "key": hex or null, "kind": "victron" | "hygrometer"}.
+A binary capture written on the device by ble_capture.Capture is fed with
+--capture, also together with --devices.
+
+The stand-in AES is pure Python, so the decrypt stage is far slower than the
+hardware accelerated cryptolib on the device. Compare it against a baseline
+taken on the same machine rather than reading it as device timing.
+"""
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "fakes"), os.path.dirname(HERE)]
+
+import micropython  # noqa: E402  (the stand-in, installs the viper builtins)
+from cryptolib import aes  # noqa: E402
+from ble_common import GenericBLE  # noqa: E402
+from ble_victron import VictronDevice  # noqa: E402
+import ble_capture  # noqa: E402
+from ble_hygrometer import Hygrometer  # noqa: E402
+
+_IRQ_SCAN_RESULT = 5
+
+# record type and cleartext length of the synthetic Victron devices
+VICTRON_TYPES = {
+    "solar": (0x01, 13),
+    "monitor": (0x02, 15),
+    "inverter": (0x03, 11),
+    "dcdc": (0x04, 10),
+    "lithium": (0x05, 16),
+    "ac_charger": (0x08, 13),
+}
+STAGES = ("filter", "decrypt", "parse", "callback")
+
+
+def victron_adv(key, record_type, nonce, cleartext):
+    counter = struct.pack("<H", nonce) + bytes(14)
+    keystream = aes(key, 1).encrypt(counter)
+    ciphertext = bytes(a ^ b for a, b in zip(cleartext, keystream))
+    header = bytes((0x02, 0x01, 0x06, 0, 0xFF, 0xE1, 0x02, 0x10, 0x00, 0xA0, 0xA0, record_type))
+    adv = bytearray(header + struct.pack("<H", nonce) + key[:1] + ciphertext)
+    adv[3] = len(adv) - 4
+    return bytes(adv)
+
+
+def hygrometer_adv(temperature, humidity):
+    adv = bytearray(25)
+    adv[0:8] = bytes((0x02, 0x01, 0x06, 21, 0xFF, 0xF0, 0xFF, 0x15))
+    adv[19:25] = struct.pack("<HhH", 3000, temperature * 16, humidity * 16)
+    return bytes(adv)
+
+
+def synthetic(packets, repeats, strangers, seed):
+    """Devices and a stream of (mac, adv_type, rssi, payload) like a crowded campsite"""
+    rng = random.Random(seed)
+    devices = []
+    for n, (kind, (record_type, length)) in enumerate(VICTRON_TYPES.items()):
+        mac = bytes((0xC0, 0x00, 0x00, 0x00, 0x00, n))
+        key = bytes(rng.randrange(256) for _ in range(16))
+        devices.append(("victron", kind, mac, key, record_type, length))
+    devices.append(("hygrometer", "hygrometer", bytes((0x62, 0x81, 0, 0, 0x07, 0x54)), None, None, None))
+
+    stream = []
+    nonces = {}
+    while len(stream) < packets:
+        if rng.random() < strangers:
+            mac = bytes(rng.randrange(256) for _ in range(6))
+            payload = bytes(rng.randrange(256) for _ in range(rng.randrange(8, 31)))
+            stream.append((mac, rng.choice((0, 2, 4)), rng.randrange(-100, -40), payload))
+            continue
+        family, kind, mac, key, record_type, length = rng.choice(devices)
+        if family == "victron":
+            nonce = nonces[mac] = (nonces.get(mac, rng.randrange(65536)) + 1) & 0xFFFF
+            cleartext = bytes(rng.randrange(256) for _ in range(length))
+            payload = victron_adv(key, record_type, nonce, cleartext)
+        else:
+            payload = hygrometer_adv(rng.randrange(-10, 40), rng.randrange(20, 90))
+        rssi = rng.randrange(-80, -40)
+        # devices resend the same advertisement until the values change
+        for _ in range(1 + rng.randrange(repeats + 1)):
+            stream.append((mac, 0, rssi, payload))
+    return [(kind, mac, key) for _, kind, mac, key, _, _ in devices], stream[:packets]
+
+
+def load_devices(devices_path):
+    with open(devices_path) as f:
+        return [
+            (d["kind"], bytes.fromhex(d["mac"]), bytes.fromhex(d["key"]) if d.get("key") else None)
+            for d in json.load(f)
+        ]
+
+
+def captured(capture_path, devices_path):
+    stream = [
+        (addr, adv_type, rssi, adv_data)
+        for _, _, addr, adv_type, rssi, adv_data in ble_capture.records(capture_path)
+    ]
+    return load_devices(devices_path), stream
+
+
+def recorded(stream_path, devices_path):
+    devices = load_devices(devices_path)
+    stream = []
+    with open(stream_path) as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                mac, adv_type, rssi, payload = line.split()
+                stream.append((bytes.fromhex(mac), int(adv_type), int(rssi), bytes.fromhex(payload)))
+    return devices, stream
+
+
+class Stats:
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, stage, ns):
+        self.samples.setdefault(stage, []).append(ns)
+
+    def timed(self, stage, func):
+        def wrapper(*args):
+            start = time.perf_counter_ns()
+            result = func(*args)
+            self.add(stage, time.perf_counter_ns() - start)
+            return result
+
+        return wrapper
+
+    def summary(self):
+        result = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            result[stage] = {
+                "calls": len(samples),
+                "mean_us": sum(samples) / len(samples) / 1000,
+                "p95_us": samples[int(len(samples) * 0.95)] / 1000,
+                "max_us": samples[-1] / 1000,
+            }
+        return result
+
+
+def build(devices, stats=None):
+    """A GenericBLE with the devices registered, instrumented when stats is given"""
+    ble = GenericBLE(auto_process=False)
+    registered = []
+    for kind, mac, key in devices:
+        callback = (lambda toggle, data: None)
+        if kind == "hygrometer":
+            device = Hygrometer(mac, key, callback)
+        else:
+            device = VictronDevice(mac, key, callback)
+        if stats is not None:
+            if kind != "hygrometer":
+                device.uncipher = stats.timed("decrypt", device.uncipher)
+            device.parse = stats.timed("parse", device.parse)
+            device.callback = stats.timed("callback", device.callback)
+        ble.register_device(device)
+        registered.append(device)
+    return ble, registered
+
+
+def feed(ble, stream, stats=None):
+    irq = ble._ble.irq_handler
+    process = ble.process
+    for mac, adv_type, rssi, payload in stream:
+        data = (0, memoryview(mac), adv_type, rssi, memoryview(payload))
+        if stats is None:
+            irq(_IRQ_SCAN_RESULT, data)
+        else:
+            start = time.perf_counter_ns()
+            irq(_IRQ_SCAN_RESULT, data)
+            stats.add("filter", time.perf_counter_ns() - start)
+        process()
+
+
+def allocations(ble, stream):
+    """Mean and largest number of bytes one packet allocates, freed again or not"""
+    irq = ble._ble.irq_handler
+    process = ble.process
+    total = 0
+    largest = 0
+    tracemalloc.start()
+    for mac, adv_type, rssi, payload in stream:
+        data = (0, memoryview(mac), adv_type, rssi, memoryview(payload))
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        irq(_IRQ_SCAN_RESULT, data)
+        process()
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - base
+        largest = max(largest, peak - base)
+    tracemalloc.stop()
+    return total / len(stream), largest
+
+
+def run(devices, stream):
+    # throughput without instrumentation
+    ble, registered = build(devices)
+    start = time.perf_counter()
+    feed(ble, stream)
+    elapsed = time.perf_counter() - start
+    counters = {
+        "accepted": sum(d.accepted for d in registered),
+        "dropped": sum(d.dropped for d in registered),
+        "rejected": sum(getattr(d, "rejected", 0) for d in registered),
+        "queue_overflows": ble.queue.overflows,
+    }
+
+    # per stage latency
+    stats = Stats()
+    ble, _ = build(devices, stats)
+    feed(ble, stream, stats)
+
+    # allocations, on a fresh instance so caches start cold like on the device
+    ble, _ = build(devices)
+    feed(ble, stream[:100])
+    per_packet, largest = allocations(ble, stream)
+
+    return {
+        "packets": len(stream),
+        "packets_per_sec": len(stream) / elapsed,
+        "counters": counters,
+        "stages": stats.summary(),
+        "alloc_bytes_per_packet": per_packet,
+        "alloc_peak_bytes": largest,
+    }
+
+
+def report(result):
+    print(f"packets          {result['packets']}")
+    print(f"packets/sec      {result['packets_per_sec']:.0f}")
+    print("counters         " + " ".join(f"{k}={v}" for k, v in result["counters"].items()))
+    print(f"alloc bytes/pkt  {result['alloc_bytes_per_packet']:.1f} (transient, CPython)")
+    print(f"alloc peak bytes {result['alloc_peak_bytes']} (largest packet, CPython)")
+    print(f"{'stage':<10} {'calls':>8} {'mean us':>9} {'p95 us':>9} {'max us':>9}")
+    for stage in STAGES:
+        s = result["stages"].get(stage)
+        if s:
+            print(f"{stage:<10} {s['calls']:>8} {s['mean_us']:>9.2f} {s['p95_us']:>9.2f} {s['max_us']:>9.2f}")
+
+
+def check(result, baseline, tolerance):
+    """Return the metrics that are more than tolerance worse than the baseline"""
+    failures = []
+    if result["packets_per_sec"] < baseline["packets_per_sec"] * (1 - tolerance):
+        failures.append(f"packets/sec {result['packets_per_sec']:.0f} < baseline {baseline['packets_per_sec']:.0f}")
+    for stage, base in baseline["stages"].items():
+        now = result["stages"].get(stage)
+        if now and now["mean_us"] > base["mean_us"] * (1 + tolerance):
+            failures.append(f"{stage} mean {now['mean_us']:.2f}us > baseline {base['mean_us']:.2f}us")
+    # a few bytes of slack so a baseline close to zero does not trip on noise
+    base_alloc = baseline.get("alloc_bytes_per_packet")
+    if base_alloc is not None and result["alloc_bytes_per_packet"] > base_alloc * (1 + tolerance) + 8:
+        failures.append(
+            f"alloc bytes/pkt {result['alloc_bytes_per_packet']:.1f} > baseline {base_alloc:.1f}"
+        )
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packets", type=int, default=20000, help="synthetic packets to feed")
+    parser.add_argument("--repeats", type=int, default=4, help="max resends of a synthetic advertisement")
+    parser.add_argument("--strangers", type=float, default=0.6, help="share of packets from unknown devices")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--stream", help="recorded stream to feed instead of synthetic packets")
+    parser.add_argument("--capture", help="binary capture from ble_capture to feed instead")
+    parser.add_argument("--devices", help="devices of the recorded stream or capture (JSON)")
+    parser.add_argument("--save", help="write the results as a baseline JSON file")
+    parser.add_argument("--check", help="fail if slower than this baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown for --check")
+    args = parser.parse_args(argv)
+
+    if args.stream:
+        if not args.devices:
+            parser.error("--stream needs --devices")
+        devices, stream = recorded(args.stream, args.devices)
+    elif args.capture:
+        if not args.devices:
+            parser.error("--capture needs --devices")
+        devices, stream = captured(args.capture, args.devices)
+    else:
+        devices, stream = synthetic(args.packets, args.repeats, args.strangers, args.seed)
+
+    result = run(devices, stream)
+    report(result)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.check:
+        with open(args.check) as f:
+            failures = check(result, json.load(f), args.tolerance)
+        if failures:
+            print("\nREGRESSION against " + args.check)
+            for failure in failures:
+                print("  " + failure)
+            return 1
+        print("\nno regression against " + args.check)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,55 @@
+"""Stand-in for the MicroPython bluetooth module on CPython"""
+
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+
+
+class UUID:
+    def __init__(self, value):
+        if isinstance(value, UUID):
+            value = value._value
+        if isinstance(value, (bytes, bytearray, memoryview)) and len(value) == 2:
+            value = int.from_bytes(value, "little")
+        self._value = value
+
+    def __bytes__(self):
+        if isinstance(self._value, int):
+            return self._value.to_bytes(2, "little")
+        return bytes(self._value)
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self._value == other._value
+
+    def __hash__(self):
+        return hash(self._value)
+
+    def __repr__(self):
+        return f"UUID({self._value!r})"
+
+
+class BLE:
+    """Records the calls made by the code under test, events are fed with irq_handler"""
+
+    def __init__(self):
+        self.irq_handler = None
+        self.calls = []
+        self._active = False
+
+    def active(self, value=None):
+        if value is not None:
+            self._active = bool(value)
+        return self._active
+
+    def irq(self, handler):
+        self.irq_handler = handler
+
+    def config(self, *args, **kwargs):
+        return None
+
+    def __getattr__(self, name):
+        # gap_scan, gap_connect, gattc_write, ... are only recorded
+        if name.startswith(("gap_", "gattc_", "gatts_")):
+            return lambda *args: self.calls.append((name, args))
+        raise AttributeError(name)
@@ -0,0 +1,80 @@
+"""Stand-in for the MicroPython cryptolib module on CPython, AES-ECB only"""
+
+
+def _xtime(a):
+    a <<= 1
+    return a ^ 0x11B if a & 0x100 else a
+
+
+def _sbox():
+    sbox = [0] * 256
+    p = q = 1
+    while True:
+        # walk the multiplicative group with generator 3 and its inverse
+        p = p ^ _xtime(p)
+        q ^= q << 1
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xFF
+        if q & 0x80:
+            q ^= 0x09
+        x = q ^ (q << 1 | q >> 7) ^ (q << 2 | q >> 6) ^ (q << 3 | q >> 5) ^ (q << 4 | q >> 4)
+        sbox[p] = (x ^ 0x63) & 0xFF
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    return bytes(sbox)
+
+
+_SBOX = _sbox()
+
+
+def _expand_key(key):
+    nk = len(key) // 4
+    rounds = nk + 6
+    words = [list(key[i : i + 4]) for i in range(0, len(key), 4)]
+    rcon = 1
+    for i in range(nk, 4 * (rounds + 1)):
+        word = list(words[i - 1])
+        if i % nk == 0:
+            word = [_SBOX[b] for b in word[1:] + word[:1]]
+            word[0] ^= rcon
+            rcon = _xtime(rcon)
+        elif nk > 6 and i % nk == 4:
+            word = [_SBOX[b] for b in word]
+        words.append([a ^ b for a, b in zip(words[i - nk], word)])
+    return [sum(words[r * 4 : r * 4 + 4], []) for r in range(rounds + 1)]
+
+
+def _encrypt_block(round_keys, block):
+    state = [a ^ b for a, b in zip(block, round_keys[0])]
+    last = len(round_keys) - 1
+    for r in range(1, last + 1):
+        state = [_SBOX[b] for b in state]
+        # shift rows, the state is column major
+        state = [state[(i + 4 * (i % 4)) % 16] for i in range(16)]
+        if r != last:
+            mixed = []
+            for c in range(4):
+                a = state[c * 4 : c * 4 + 4]
+                t = a[0] ^ a[1] ^ a[2] ^ a[3]
+                mixed += [a[i] ^ t ^ _xtime(a[i] ^ a[(i + 1) % 4]) & 0xFF for i in range(4)]
+            state = mixed
+        state = [a ^ b for a, b in zip(state, round_keys[r])]
+    return bytes(state)
+
+
+class aes:
+    def __init__(self, key, mode, iv=None):
+        if mode != 1:
+            raise ValueError("only ECB mode is supported")
+        self._round_keys = _expand_key(bytes(key))
+
+    def encrypt(self, in_buf, out_buf=None):
+        data = bytes(in_buf)
+        out = b"".join(
+            _encrypt_block(self._round_keys, data[i : i + 16]) for i in range(0, len(data), 16)
+        )
+        if out_buf is None:
+            return out
+        out_buf[: len(out)] = out
@@ -0,0 +1,63 @@
+"""Stand-in for the MicroPython machine module on CPython"""
+
+
+class Pin:
+    IN = 1
+    OUT = 3
+    IRQ_FALLING = 2
+    IRQ_RISING = 1
+
+    def __init__(self, pin, mode=None, value=None):
+        self.pin = pin
+        self._value = value or 0
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def irq(self, handler=None, trigger=None):
+        self.handler = handler
+
+
+class SPI:
+    def __init__(self, *args, **kwargs):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+
+class PWM:
+    def __init__(self, pin, freq=0, duty=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+
+
+class Timer:
+    def __init__(self, id, period=0, callback=None):
+        self.callback = callback
+
+    def deinit(self):
+        pass
+
+
+def reset():
+    raise SystemExit("machine.reset()")
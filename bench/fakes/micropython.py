@@ -0,0 +1,52 @@
+"""Stand-in for the MicroPython micropython module on CPython
+
+Also installs const and the viper pointer casts as builtins, the way the
+MicroPython compiler makes them available to the modules of this repo.
+"""
+import builtins
+
+_pending = []
+
+
+def const(value):
+    return value
+
+
+def viper(func):
+    return func
+
+
+def native(func):
+    return func
+
+
+def schedule(func, arg):
+    if len(_pending) >= 8:
+        raise RuntimeError("schedule queue full")
+    _pending.append((func, arg))
+
+
+def run_scheduled():
+    """Run the functions passed to schedule, like the MicroPython VM does between bytecodes"""
+    while _pending:
+        func, arg = _pending.pop(0)
+        func(arg)
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def _ptr16(buf):
+    return memoryview(buf).cast("B").cast("H")
+
+
+def _ptr32(buf):
+    return memoryview(buf).cast("B").cast("I")
+
+
+builtins.const = const
+builtins.uint = int
+builtins.ptr8 = lambda buf: buf
+builtins.ptr16 = _ptr16
+builtins.ptr32 = _ptr32
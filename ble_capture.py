@@ -0,0 +1,135 @@
+import struct
+from micropython import const
+
+try:
+    from time import ticks_ms, ticks_diff, sleep_ms
+except ImportError:
+    # CPython, used to replay captures on a PC
+    import time
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000) & 0x3FFFFFFF
+
+    def ticks_diff(a, b):
+        return ((a - b + 0x20000000) & 0x3FFFFFFF) - 0x20000000
+
+    def sleep_ms(ms):
+        time.sleep(ms / 1000)
+
+
+_IRQ_SCAN_RESULT = const(5)
+
+# record: ticks_ms, addr_type, addr, adv_type, rssi, payload length, payload
+_HEADER = "<IB6sBbB"
+_HEADER_SIZE = const(14)
+
+
+class Capture:
+    """Records raw scan results exactly as the radio delivered them
+
+    Records are appended from the BLE IRQ to one of two preallocated RAM
+    blocks. When a block is full the other one takes over and flush() appends
+    the full block to the file in one write. Records that arrive while both
+    blocks are full are counted in dropped.
+    """
+
+    def __init__(self, path: str, block_size: int = 4096):
+        self.path = path
+        self.active = True
+        self.records = 0
+        self.dropped = 0
+        self._blocks = (bytearray(block_size), bytearray(block_size))
+        self._lengths = [0, 0]
+        self._current = 0
+        self._full = -1
+
+    def record(self, addr_type: int, addr, adv_type: int, rssi: int, adv_data):
+        if not self.active:
+            return
+        size = _HEADER_SIZE + len(adv_data)
+        current = self._current
+        used = self._lengths[current]
+        if used + size > len(self._blocks[current]):
+            if self._full >= 0:
+                self.dropped += 1
+                return
+            self._full = current
+            current = self._current = current ^ 1
+            used = 0
+        block = self._blocks[current]
+        ticks = ticks_ms()
+        block[used] = ticks & 0xFF
+        block[used + 1] = (ticks >> 8) & 0xFF
+        block[used + 2] = (ticks >> 16) & 0xFF
+        block[used + 3] = (ticks >> 24) & 0xFF
+        block[used + 4] = addr_type
+        for i in range(6):
+            block[used + 5 + i] = addr[i]
+        block[used + 11] = adv_type
+        block[used + 12] = rssi & 0xFF
+        block[used + 13] = len(adv_data)
+        used += _HEADER_SIZE
+        for b in adv_data:
+            block[used] = b
+            used += 1
+        self._lengths[current] = used
+        self.records += 1
+
+    def flush(self):
+        """Append a full block to the file, call outside of the IRQ"""
+        full = self._full
+        if full >= 0:
+            self._write(full)
+            self._full = -1
+
+    def close(self):
+        """Stop capturing and write everything recorded so far"""
+        self.active = False
+        self.flush()
+        self._write(self._current)
+
+    def _write(self, index: int):
+        with open(self.path, "ab") as f:
+            f.write(memoryview(self._blocks[index])[: self._lengths[index]])
+        self._lengths[index] = 0
+
+
+def records(path: str):
+    """Yield (ticks_ms, addr_type, addr, adv_type, rssi, adv_data) from a capture file"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(_HEADER_SIZE)
+            if len(header) < _HEADER_SIZE:
+                return
+            ticks, addr_type, addr, adv_type, rssi, length = struct.unpack(_HEADER, header)
+            adv_data = f.read(length)
+            if len(adv_data) < length:
+                return
+            yield ticks, addr_type, addr, adv_type, rssi, adv_data
+
+
+def replay(ble, path: str, speed: float = 1):
+    """Feed a capture back through ble.handle_ble_scan
+
+    speed 1 replays in real time, 10 ten times faster and 0 as fast as
+    possible. When ble does not process its queue by itself, process() is
+    called after every record. Returns the number of records replayed.
+    """
+    count = 0
+    first = None
+    start = ticks_ms()
+    for ticks, addr_type, addr, adv_type, rssi, adv_data in records(path):
+        if first is None:
+            first = ticks
+        if speed:
+            due = int(ticks_diff(ticks, first) / speed)
+            wait = due - ticks_diff(ticks_ms(), start)
+            if wait > 0:
+                sleep_ms(wait)
+        ble.handle_ble_scan(
+            _IRQ_SCAN_RESULT, (addr_type, memoryview(addr), adv_type, rssi, memoryview(adv_data))
+        )
+        if not ble.auto_process:
+            ble.process()
+        count += 1
+    return count
@@ -1,9 +1,16 @@
 import bluetooth
+import json
 import struct
+import time
+import micropython
+from array import array
 from micropython import const
-from ble_advertising import decode_services
 
 _BT_MIN_RSSI = const(-85)
+# longest legacy advertising payload
+_MAX_ADV_LEN = const(31)
+# longest GATT notification kept, the default MTU allows 20 bytes
+_MAX_NOTIFY_LEN = const(64)
 
 _IRQ_SCAN_RESULT = const(5)
 _IRQ_PERIPHERAL_CONNECT = const(7)
@@ -20,16 +27,117 @@ _IRQ_GATTC_WRITE_DONE = const(17)
 _IRQ_GATTC_NOTIFY = const(18)
 _IRQ_CONNECTION_UPDATE = const(27)
 
+_CCCD_UUID = bluetooth.UUID(0x2902)
+_NOTIFY_ENABLE = b"\x01\x00"
+
+# connection handle of a failed gap_connect
+_NO_HANDLE = const(0xFFFF)
+_ENOMEM = const(12)
+
+# GATT operations of the per connection queue
+_OP_SERVICES = const(0)
+_OP_CHARACTERISTICS = const(1)
+_OP_DESCRIPTORS = const(2)
+_OP_READ = const(3)
+_OP_WRITE = const(4)
+_OP_WRITE_NO_RESPONSE = const(5)
+_OP_CALL = const(6)
+
+# status of a GATT operation besides the ones of the stack
+TIMEOUT = const(-1)
+DISCONNECTED = const(-2)
+
+# Connection states
+IDLE = const(0)
+WAITING = const(1)
+CONNECTING = const(2)
+DISCOVERING = const(3)
+READY = const(4)
+
+
+@micropython.viper
+def copy_bytes(dst, src, start: int, length: int):
+    """Copy length bytes from src[start:] to the start of dst"""
+    d = ptr8(dst)
+    s = ptr8(src)
+    for i in range(length):
+        d[i] = s[start + i]
+
+
+@micropython.viper
+def equal_bytes(a, b, length: int) -> bool:
+    """Compare the first length bytes of a and b"""
+    x = ptr8(a)
+    y = ptr8(b)
+    for i in range(length):
+        if x[i] != y[i]:
+            return False
+    return True
+
+
+def _prefix_key(data, start: int = 0) -> int:
+    """Three bytes of data as a small int usable as dict key without allocating"""
+    return data[start] << 16 | data[start + 1] << 8 | data[start + 2]
+
 
 class SensorDevice:
     """A SensorDevice base class"""
 
+    # manufacturer data prefix, adv_data[5:8], of the advertisements to decode
+    ADV_PREFIX = None
+    # GATT service of devices that are connected to instead of only scanned
+    SERVICE_UUID = None
+    ADDR_TYPE = 0
+
     def __init__(self, mac: str, key: str, callback):
         self._mac = mac
         self._key = key
         self.callback = callback
         self._toggle = False
         self._data = {}
+        self._last_adv = bytearray(_MAX_ADV_LEN)
+        self._last_adv_len = 0
+        self._queued = -1
+        self.accepted = 0
+        self.dropped = 0
+        # a history.History and a flashlog.FlashLog to keep the readings in
+        self.history = None
+        self.log = None
+
+    def accept(self, adv_data: memoryview) -> bool:
+        """Return False for an exact repeat of the last accepted advertisement"""
+        length = len(adv_data)
+        if length == self._last_adv_len and equal_bytes(adv_data, self._last_adv, length):
+            self.dropped += 1
+            return False
+        if length <= _MAX_ADV_LEN:
+            copy_bytes(self._last_adv, adv_data, 0, length)
+            self._last_adv_len = length
+        self.accepted += 1
+        return True
+
+    def decode(self, adv_data: memoryview) -> dict:
+        """Return the readings in an accepted advertisement, None if unchanged"""
+        return self.parse(adv_data)
+
+    def record(self, data: dict):
+        """Add new readings to the history and log, if the device keeps them"""
+        if self.history is not None:
+            self.history.add(time.time(), data)
+        if self.log is not None:
+            self.log.add(time.time(), data)
+
+    def on_ready(self, ble, connection):
+        """Called when connected, discovered and subscribed to notifications"""
+
+    def on_disconnected(self, ble, connection):
+        """Called when a ready connection is lost"""
+
+    def on_notify(self, ble, value_handle: int, notify_data: memoryview):
+        """Called from GenericBLE.process() with a notification, notify_data is only valid during the call"""
+
+    def on_read_result(self, ble, value_handle: int, char_data: memoryview):
+        pass
 
     def _return_if_changed(self, data: dict):
         if self._data == data:
@@ -38,109 +146,734 @@ class SensorDevice:
         return self._data
 
 
+class ScanQueue:
+    """Fixed size queue of scan results filled from the BLE IRQ
+
+    The IRQ only copies the result into preallocated slots. A device has at
+    most one result waiting behind the head of the queue, a newer result
+    replaces it. When the queue is full other results are dropped. Results
+    are only ever written by the IRQ and read by the consumer, so no locking
+    is needed.
+
+    GATT notifications use a queue of their own with replace False, where
+    every notification is kept and adv_type carries the value handle.
+    """
+
+    def __init__(self, depth: int = 8, size: int = _MAX_ADV_LEN, replace: bool = True):
+        self.depth = depth
+        self.size = size
+        self._replace = replace
+        self._devices = [None] * depth
+        self._adv_types = array("H", bytes(2 * depth))
+        self._rssi = array("b", bytes(depth))
+        self._lengths = bytearray(depth)
+        self._payloads = [bytearray(size) for _ in range(depth)]
+        self._work = bytearray(size)
+        self._view = memoryview(self._work)
+        self._put = 0
+        self._got = 0
+        self.queued = 0
+        self.replaced = 0
+        self.overflows = 0
+
+    def __len__(self):
+        return self._put - self._got
+
+    def put(self, device: SensorDevice, adv_type: int, rssi: int, adv_data: memoryview) -> bool:
+        """Copy a scan result into the queue, False if it was dropped"""
+        length = len(adv_data)
+        index = device._queued if self._replace else -1
+        if length > self.size:
+            self.overflows += 1
+            return False
+        if index > self._got:
+            # the older result has not been picked up yet, replace it
+            self.replaced += 1
+        elif self._put - self._got < self.depth:
+            index = self._put
+            if self._replace:
+                device._queued = index
+            self._put = index + 1
+            self.queued += 1
+        else:
+            self.overflows += 1
+            return False
+        slot = index % self.depth
+        self._devices[slot] = device
+        self._adv_types[slot] = adv_type
+        self._rssi[slot] = rssi
+        self._lengths[slot] = length
+        copy_bytes(self._payloads[slot], adv_data, 0, length)
+        return True
+
+    def get(self):
+        """Return (device, adv_type, rssi, adv_data) of the oldest result or None
+
+        adv_data is only valid until the next call.
+        """
+        got = self._got
+        if got == self._put:
+            return None
+        slot = got % self.depth
+        length = self._lengths[slot]
+        copy_bytes(self._work, self._payloads[slot], 0, length)
+        result = (self._devices[slot], self._adv_types[slot], self._rssi[slot], self._view[:length])
+        self._got = got + 1
+        return result
+
+
 class GenericBLE:
-    """Generic Bluetooth scanner"""
+    """Generic Bluetooth scanner
+
+    Scan results from registered devices are queued by the BLE IRQ and
+    decoded later by process(), which is scheduled with micropython.schedule
+    unless auto_process is False and the application calls it itself. In
+    that case on_result is called from the IRQ after a result is queued.
+    GATT notifications of connected devices are queued the same way and
+    passed to SensorDevice.on_notify by process().
+
+    Scan results are dispatched on the manufacturer prefix in adv_data[5:8]
+    to a handler registered with register_prefix, devices with an
+    ADV_PREFIX register theirs when they are added.
 
-    def __init__(self):
+    Set capture to a ble_capture.Capture to record every scan result before
+    it is filtered, ble_capture.replay feeds a recording back in.
+    """
+
+    def __init__(self, queue_depth: int = 8, auto_process: bool = True):
         self._MACS = {}
-        self._CON_HANDLE = {}
-        self._CONNECT = {}
+        self._MAC_INDEX = {}
+        self._PREFIXES = {}
+        self.queue = ScanQueue(queue_depth)
+        # notifications are handled by process() as well, never in the IRQ
+        self.notifications = ScanQueue(4, _MAX_NOTIFY_LEN, False)
+        self.auto_process = auto_process
+        self._scheduled = False
+        self._process_cb = self._scheduled_process
+        self.on_result = None
+        self.capture = None
+        self.scanning = False
+        self._scan_interval_us = 3000000
+        self._scan_window_us = 400000
+        # a ble_scan.ScanScheduler deciding when to scan
+        self.scheduler = None
         self._ble = bluetooth.BLE()
+        self.connections = Connections(self)
+        connections = self.connections
+        self._EVENTS = {
+            _IRQ_PERIPHERAL_CONNECT: connections._on_connect,
+            _IRQ_PERIPHERAL_DISCONNECT: connections._on_disconnect,
+            _IRQ_GATTC_SERVICE_RESULT: connections._on_service_result,
+            _IRQ_GATTC_SERVICE_DONE: connections._on_service_done,
+            _IRQ_GATTC_CHARACTERISTIC_RESULT: connections._on_characteristic_result,
+            _IRQ_GATTC_CHARACTERISTIC_DONE: connections._on_characteristic_done,
+            _IRQ_GATTC_DESCRIPTOR_RESULT: connections._on_descriptor_result,
+            _IRQ_GATTC_DESCRIPTOR_DONE: connections._on_descriptor_done,
+            _IRQ_GATTC_NOTIFY: connections._on_notify,
+            _IRQ_GATTC_READ_RESULT: connections._on_read_result,
+            _IRQ_GATTC_READ_DONE: connections._on_read_done,
+            _IRQ_GATTC_WRITE_DONE: connections._on_write_done,
+            _IRQ_CONNECTION_UPDATE: connections._on_connection_update,
+        }
         self._ble.active(True)
         self._ble.irq(self.handle_ble_scan)
 
     def register_device(self, device: SensorDevice):
-        self._MACS[device._mac] = device
+        mac = device._mac
+        self._MACS[mac] = device
+        self._MAC_INDEX.setdefault(_prefix_key(mac, 3), []).append(device)
+        prefix = device.ADV_PREFIX
+        if prefix is not None and _prefix_key(prefix) not in self._PREFIXES:
+            self.register_prefix(prefix, self._queue_result)
+        if device.SERVICE_UUID is not None:
+            self.connections.add(device)
+
+    def register_prefix(self, prefix: bytes, handler):
+        """Call handler(device, adv_type, rssi, adv_data) for new advertisements with prefix at adv_data[5:8]"""
+        self._PREFIXES[_prefix_key(prefix)] = handler
+
+    def start(self, interval_us: int = None, window_us: int = None):
+        """Scan until paused or stopped, with the last used interval and window when not given"""
+        if interval_us is not None:
+            self._scan_interval_us = interval_us
+            self._scan_window_us = window_us
+        self._ble.gap_scan(0, self._scan_interval_us, self._scan_window_us)
+        self.scanning = True
 
-    def start(self):
-        self._ble.gap_scan(0, 3000000, 400000)
+    def pause(self):
+        """Stop scanning for now, start() carries on"""
+        self._ble.gap_scan(None)
+        self.scanning = False
 
     def stop(self):
+        self.connections.stop()
+        if self.scheduler is not None:
+            self.scheduler.active = False
+        self.pause()
         self._ble.active(False)
-        self._ble.BLE().gap_scan(None, 3000000, 400000)
+
+    def process(self):
+        """Decode the queued scan results and pass them to the device callbacks
+
+        Also hands the queued GATT notifications to SensorDevice.on_notify.
+        """
+        notifications = self.notifications
+        while True:
+            result = notifications.get()
+            if result is None:
+                break
+            result[0].on_notify(self._ble, result[1], result[3])
+        queue = self.queue
+        while True:
+            result = queue.get()
+            if result is None:
+                return
+            device = result[0]
+            device_data = device.decode(result[3])
+            # unchanged readings count as samples too
+            if device._data:
+                device.record(device._data)
+            device._toggle = False if device._toggle else True
+            device.callback(device._toggle, device_data)
+
+    def _scheduled_process(self, _):
+        self._scheduled = False
+        self.process()
+
+    def _queue_result(self, device: SensorDevice, adv_type: int, rssi: int, adv_data: memoryview):
+        if not self.queue.put(device, adv_type, rssi, adv_data):
+            # lost, so a resend of it must not be dropped as a repeat
+            device._last_adv_len = 0
+            return
+        self._wake()
+
+    def _queue_notify(self, device: SensorDevice, value_handle: int, notify_data: memoryview):
+        if self.notifications.put(device, value_handle, 0, notify_data):
+            self._wake()
+
+    def _wake(self):
+        """Get process() to run, called from the IRQ"""
+        if not self.auto_process:
+            if self.on_result is not None:
+                self.on_result()
+        elif not self._scheduled:
+            try:
+                micropython.schedule(self._process_cb, None)
+                self._scheduled = True
+            except RuntimeError:
+                # schedule queue full, the next result will try again
+                pass
 
     def handle_ble_scan(self, event, data):
         if event == _IRQ_SCAN_RESULT:
-            addr_type, addr, adv_type, rssi, adv_data = data
-#            mac = ':'.join(['{:02X}'.format(b) for b in addr])
-#            print(mac)
-            if (
-                rssi > _BT_MIN_RSSI
-                and adv_data[5:8] == b"\xE1\x02\x10"
-                and (adv_type == 0 or adv_type == 2)
-                and adv_data[1:2] == b"\x01"
-            ):
-                baddr = bytes(addr)
-                if baddr in self._MACS:
-                    device = self._MACS[baddr]
-                    cleartext = device.uncipher(adv_data)
-                    device_data = device.parse(cleartext)
-                    device._toggle = False if device._toggle else True
-                    device.callback(device._toggle, device_data)
-            elif (
-                rssi > _BT_MIN_RSSI
-                and adv_data[5:8] == b"\xF0\xFF\x15"
-                and (adv_type == 0 or adv_type == 2)
-                and adv_data[1:2] == b"\x01"
-            ):
-                baddr = bytes(addr)
-                if baddr in self._MACS:
-                    device = self._MACS[baddr]
-                    device_data = device.parse(adv_data)
-                    device._toggle = False if device._toggle else True
-                    device.callback(device._toggle, device_data)
-            # elif adv_type in (0, 1) and _FRIDGE_SERVICE_UUID in decode_services(
-            #     adv_data
-            # ):
-            #     mac = ':'.join(['{:02X}'.format(b) for b in addr])
-            #     print(mac)
-            #     print(bytes(addr))
-        elif event ==_IRQ_PERIPHERAL_CONNECT:
-            conn_handle, addr_type, addr = data
-            device = self._MACS[bytes(addr)]
-            self._CON_HANDLE[conn_handle] = device
-            device.on_connected(self._ble, conn_handle, addr_type, addr)
-        elif event == _IRQ_GATTC_SERVICE_RESULT:
-            conn_handle, start_handle, end_handle, uuid = data
-            device = self._CON_HANDLE[conn_handle]
-            device.on_service_result(self._ble, conn_handle, start_handle, end_handle, uuid)
-        elif event == _IRQ_GATTC_SERVICE_DONE:
-            conn_handle, status = data
-            device = self._CON_HANDLE[conn_handle]
-            device.on_service_done(self._ble, conn_handle)
-        elif event == _IRQ_GATTC_CHARACTERISTIC_RESULT:
-            conn_handle, def_handle, value_handle, properties, uuid = data
-            device = self._CON_HANDLE[conn_handle]
-            device.on_characteristic_result(self._ble, conn_handle, def_handle, value_handle, properties, uuid)
-        elif event == _IRQ_GATTC_CHARACTERISTIC_DONE:
-            conn_handle, status = data
-            device = self._CON_HANDLE[conn_handle]
-            device.on_characteristic_done(self._ble, conn_handle)
-        elif event == _IRQ_GATTC_DESCRIPTOR_RESULT:
-            conn_handle, dsc_handle, uuid = data
-            device = self._CON_HANDLE[conn_handle]
-            device.on_descriptor_result(self._ble, conn_handle, dsc_handle, uuid)
-        elif event == _IRQ_GATTC_DESCRIPTOR_DONE:
-            conn_handle, status = data
-            device = self._CON_HANDLE[conn_handle]
-            device.on_descriptor_done(self._ble, conn_handle)
-        elif event == _IRQ_GATTC_NOTIFY:
-            conn_handle, value_handle, notify_data = data
-            device = self._CON_HANDLE[conn_handle]
-            device.on_notify(self._ble, value_handle, notify_data)
-        elif event == _IRQ_GATTC_READ_RESULT:
-            conn_handle, value_handle, char_data = data
-            device = self._CON_HANDLE[conn_handle]
-            device.on_read_result(self._ble, value_handle, char_data)
-        elif event == _IRQ_GATTC_WRITE_DONE:
-            print("gattc_write event")
-        elif event == _IRQ_CONNECTION_UPDATE:
-            # The remote device has updated connection parameters.
-            conn_handle, conn_interval, conn_latency, supervision_timeout, status = data
-            print(f"connection update {conn_handle} {conn_interval} {conn_latency} {status}")
-        elif event == _IRQ_PERIPHERAL_DISCONNECT:
-            conn_handle, addr_type, addr = data
-            print("disconnected")
-            # what to do?
+            self._on_scan_result(data)
+            return
+        handler = self._EVENTS.get(event)
+        if handler is not None:
+            handler(data)
+        else:
+            print(f"something else? event( {event} )")
+
+    def _find_device(self, addr):
+        """Look up a registered device by address without allocating"""
+        devices = self._MAC_INDEX.get(_prefix_key(addr, 3))
+        if devices is not None:
+            for device in devices:
+                if equal_bytes(device._mac, addr, 6):
+                    return device
+        return None
+
+    def _on_scan_result(self, data):
+        addr_type, addr, adv_type, rssi, adv_data = data
+        if self.capture is not None:
+            self.capture.record(addr_type, addr, adv_type, rssi, adv_data)
+        if self.connections.waiting:
+            self.connections.seen(addr_type, addr)
+        if (
+            rssi <= _BT_MIN_RSSI
+            or (adv_type != 0 and adv_type != 2)
+            or len(adv_data) < 8
+            or adv_data[1] != 0x01
+        ):
+            return
+        handler = self._PREFIXES.get(_prefix_key(adv_data, 5))
+        if handler is None:
+            return
+        device = self._find_device(addr)
+        if device is not None and self.scheduler is not None:
+            self.scheduler.seen(device)
+        if device is not None and device.accept(adv_data):
+            handler(device, adv_type, rssi, adv_data)
+
+
+class Connection:
+    """State of the GATT connection to one device
+
+    GATT operations are queued and run one at a time, the next one starts
+    when the stack reports the previous one done. done callbacks are called
+    as done(connection, status, data) with status 0 on success.
+    """
+
+    def __init__(self, device: SensorDevice, manager):
+        self.device = device
+        self.state = IDLE
+        self.handle = None
+        self.addr_type = device.ADDR_TYPE
+        self.attempts = 0
+        self.retry_at = 0
+        self.interval_us = 0
+        # (uuid, value_handle) of the characteristics of the service
+        self.characteristics = []
+        self.cccds = []
+        self.start_handle = 0
+        self.end_handle = 0
+        # the handles came from the cache instead of discovery
+        self.cached = False
+        self._manager = manager
+        self._ops = []
+        self._current = None
+        self._started = 0
+        self._running = False
+        self.connects = 0
+        self.failures = 0
+        self.disconnects = 0
+        self.operations = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def value_handle(self, uuid):
+        """The value handle of a characteristic, None if the service has no such characteristic"""
+        for characteristic_uuid, value_handle in self.characteristics:
+            if characteristic_uuid == uuid:
+                return value_handle
+        return None
+
+    def read(self, value_handle: int, done=None):
+        """Queue a read, without done the value goes to device.on_read_result"""
+        self._manager._queue(self, [_OP_READ, value_handle, None, done])
+
+    def write(self, value_handle: int, data, response: bool = False, done=None):
+        """Queue a write
+
+        Writes without response only wait for the stack to take the data, so
+        a run of them goes out back to back.
+        """
+        self._manager._queue(
+            self, [_OP_WRITE if response else _OP_WRITE_NO_RESPONSE, value_handle, data, done]
+        )
+
+    def subscribe(self, cccd_handle: int, done=None):
+        """Queue enabling notifications"""
+        self.write(cccd_handle, _NOTIFY_ENABLE, True, done)
+
+
+class Connections:
+    """Keeps GATT connections to any number of devices
+
+    Devices with a SERVICE_UUID are connected to when they are registered.
+    A connection discovers the characteristics of the service and its
+    descriptors, enables notifications on every client characteristic
+    configuration descriptor and then calls device.on_ready, all through
+    the operation queue of the connection. A lost or failed connection is
+    retried after a delay that doubles with every failure up to
+    max_backoff_ms, or right away once the device is seen advertising. The
+    connection interval is asked for at connect time, a long one saves
+    power on both ends.
+
+    tick() starts the connection attempts, times out GATT operations that
+    take longer than op_timeout_ms and has to be called regularly. The stack
+    only makes one connection attempt at a time and scanning is paused
+    meanwhile. A timed out operation drops the connection, queued operations
+    fail with DISCONNECTED when the connection is lost.
+
+    With use_cache the discovered handles are kept in a file per MAC and a
+    reconnect subscribes right away. When enabling a notification then
+    fails the cached handles are dropped and discovered again.
+    """
+
+    def __init__(
+        self,
+        ble: GenericBLE,
+        min_interval_us: int = 250000,
+        max_interval_us: int = 500000,
+        connect_ms: int = 2000,
+        min_backoff_ms: int = 500,
+        max_backoff_ms: int = 30000,
+        op_timeout_ms: int = 5000,
+    ):
+        self._generic = ble
+        self.min_interval_us = min_interval_us
+        self.max_interval_us = max_interval_us
+        self.connect_ms = connect_ms
+        self.min_backoff_ms = min_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.op_timeout_ms = op_timeout_ms
+        self._connections = {}
+        self._by_handle = {}
+        self._connecting = None
+        self._resume_scan = False
+        self.waiting = 0
+        self._cache_path = None
+        self._cache = {}
+
+    def use_cache(self, path: str):
+        """Keep discovered handles in the file at path"""
+        self._cache_path = path
+        try:
+            with open(path) as f:
+                self._cache = json.load(f)
+        except (OSError, ValueError):
+            self._cache = {}
+
+    def add(self, device: SensorDevice):
+        connection = self._connections[device._mac] = Connection(device, self)
+        self._wait(connection, 0)
+        return connection
+
+    def get(self, device: SensorDevice) -> Connection:
+        return self._connections.get(device._mac)
+
+    def disconnect(self, device: SensorDevice):
+        """Drop the connection to a device, it is made again after the backoff"""
+        connection = self._connections[device._mac]
+        if connection.handle is not None:
+            self._generic._ble.gap_disconnect(connection.handle)
+
+    def stop(self):
+        """Stop making connections"""
+        for connection in self._connections.values():
+            if connection.state == WAITING:
+                self.waiting -= 1
+            connection.state = IDLE
+
+    def tick(self):
+        """Start a due connection attempt, time out operations and connection attempts"""
+        now = time.ticks_ms()
+        for connection in list(self._by_handle.values()):
+            current = connection._current
+            if current is not None:
+                if time.ticks_diff(now, connection._started) > self.op_timeout_ms:
+                    connection.timeouts += 1
+                    self._complete(connection, TIMEOUT, None)
+                    # the stack may still be busy with it, start over
+                    self._generic._ble.gap_disconnect(connection.handle)
+            elif connection._ops:
+                # writes the stack had no room for
+                self._run(connection)
+        connecting = self._connecting
+        if connecting is not None:
+            if time.ticks_diff(now, connecting.retry_at) > self.connect_ms + 1000:
+                # no result from the stack
+                self._failed(connecting)
+            return
+        for connection in self._connections.values():
+            if connection.state == WAITING and time.ticks_diff(now, connection.retry_at) >= 0:
+                self._connect(connection, now)
+                return
+
+    def seen(self, addr_type: int, addr):
+        """A waiting device that advertises can be connected to right away"""
+        device = self._generic._find_device(addr)
+        if device is not None:
+            connection = self._connections.get(device._mac)
+            if connection is not None and connection.state == WAITING:
+                connection.addr_type = addr_type
+                connection.retry_at = time.ticks_ms()
+
+    def _wait(self, connection: Connection, delay_ms: int):
+        if connection.state != WAITING:
+            self.waiting += 1
+        connection.state = WAITING
+        connection.retry_at = time.ticks_add(time.ticks_ms(), delay_ms)
+
+    def _backoff(self, connection: Connection):
+        delay = self.min_backoff_ms << min(connection.attempts, 16)
+        connection.attempts += 1
+        self._wait(connection, min(delay, self.max_backoff_ms))
+
+    def _connect(self, connection: Connection, now: int):
+        generic = self._generic
+        self.waiting -= 1
+        connection.state = CONNECTING
+        connection.retry_at = now
+        self._connecting = connection
+        # the stack can not scan and connect at the same time
+        self._resume_scan = generic.scanning
+        if generic.scanning:
+            generic.pause()
+        try:
+            generic._ble.gap_connect(
+                connection.addr_type,
+                connection.device._mac,
+                self.connect_ms,
+                self.min_interval_us,
+                self.max_interval_us,
+            )
+        except OSError:
+            self._failed(connection)
+
+    def _connect_finished(self):
+        self._connecting = None
+        if self._resume_scan:
+            self._resume_scan = False
+            scheduler = self._generic.scheduler
+            # a scan scheduler that closed its window meanwhile reopens it when due
+            if scheduler is None or scheduler.window_open:
+                self._generic.start()
+
+    def _failed(self, connection: Connection):
+        connection.failures += 1
+        if connection is self._connecting:
+            self._connect_finished()
+        if connection.handle is not None:
+            self._by_handle.pop(connection.handle, None)
+            connection.handle = None
+        if connection.state != IDLE:
+            self._backoff(connection)
+
+    def _queue(self, connection: Connection, op: list):
+        if connection.handle is None:
+            self._done(connection, op, DISCONNECTED, None)
+            return
+        connection._ops.append(op)
+        if connection._current is None and not connection._running:
+            self._run(connection)
+
+    def _run(self, connection: Connection):
+        """Start queued operations until one has to wait for the stack"""
+        ble = self._generic._ble
+        ops = connection._ops
+        connection._running = True
+        while connection._current is None and ops and connection.handle is not None:
+            op = ops[0]
+            kind = op[0]
+            conn_handle = connection.handle
+            try:
+                if kind == _OP_SERVICES:
+                    ble.gattc_discover_services(conn_handle, connection.device.SERVICE_UUID)
+                elif kind == _OP_CHARACTERISTICS:
+                    ble.gattc_discover_characteristics(conn_handle, connection.start_handle, connection.end_handle)
+                elif kind == _OP_DESCRIPTORS:
+                    ble.gattc_discover_descriptors(conn_handle, connection.start_handle, connection.end_handle)
+                elif kind == _OP_READ:
+                    ble.gattc_read(conn_handle, op[1])
+                elif kind == _OP_WRITE:
+                    ble.gattc_write(conn_handle, op[1], op[2], 1)
+                elif kind == _OP_WRITE_NO_RESPONSE:
+                    ble.gattc_write(conn_handle, op[1], op[2], 0)
+            except OSError as e:
+                if kind == _OP_WRITE_NO_RESPONSE and e.errno == _ENOMEM:
+                    # no room in the stack, tick() tries again
+                    break
+                ops.pop(0)
+                self._done(connection, op, e.errno, None)
+                continue
+            ops.pop(0)
+            if kind == _OP_WRITE_NO_RESPONSE or kind == _OP_CALL:
+                self._done(connection, op, 0, None)
+            else:
+                connection._current = op
+                connection._started = time.ticks_ms()
+        connection._running = False
+
+    def _complete(self, connection: Connection, status: int, data):
+        """The operation waiting for the stack is done"""
+        if connection is None or connection._current is None:
+            return
+        op = connection._current
+        connection._current = None
+        self._done(connection, op, status, data)
+        self._run(connection)
+
+    def _done(self, connection: Connection, op: list, status: int, data):
+        connection.operations += 1
+        if status:
+            connection.errors += 1
+            print(f"gatt operation {op[0]} handle {op[1]} failed {status}")
+        done = op[3]
+        if done is not None:
+            done(connection, status, data)
+        elif op[0] == _OP_READ and not status:
+            connection.device.on_read_result(self._generic._ble, op[1], data)
+
+    def _fail_ops(self, connection: Connection):
+        ops = connection._ops
+        connection._ops = []
+        op = connection._current
+        connection._current = None
+        if op is not None:
+            self._done(connection, op, DISCONNECTED, None)
+        for op in ops:
+            self._done(connection, op, DISCONNECTED, None)
+
+    def _on_connect(self, data):
+        conn_handle, addr_type, addr = data
+        connection = self._connections.get(bytes(addr))
+        if connection is None or connection.state != CONNECTING:
+            self._generic._ble.gap_disconnect(conn_handle)
+            return
+        self._connect_finished()
+        connection.handle = conn_handle
+        connection.state = DISCOVERING
+        connection.connects += 1
+        self._by_handle[conn_handle] = connection
+        if self._load_handles(connection):
+            self._subscribe(connection)
         else:
-            print(f"something else? event( {event} )")
\ No newline at end of file
+            self._discover(connection)
+
+    def _discover(self, connection: Connection):
+        connection.cached = False
+        connection.characteristics = []
+        connection.cccds = []
+        connection.start_handle = connection.end_handle = 0
+        self._queue(connection, [_OP_SERVICES, 0, None, self._services_done])
+
+    def _services_done(self, connection: Connection, status: int, _):
+        if status or not connection.start_handle:
+            if not status:
+                print("service not found")
+            self._generic._ble.gap_disconnect(connection.handle)
+            return
+        self._queue(connection, [_OP_CHARACTERISTICS, connection.start_handle, None, None])
+        self._queue(connection, [_OP_DESCRIPTORS, connection.start_handle, None, self._descriptors_done])
+
+    def _descriptors_done(self, connection: Connection, status: int, _):
+        if status:
+            self._generic._ble.gap_disconnect(connection.handle)
+            return
+        self._save_handles(connection)
+        self._subscribe(connection)
+
+    def _subscribe(self, connection: Connection):
+        """Enable notifications one descriptor at a time, then the connection is ready"""
+        for cccd in connection.cccds:
+            connection.subscribe(cccd, self._subscribed)
+        self._queue(connection, [_OP_CALL, 0, None, self._ready])
+
+    def _subscribed(self, connection: Connection, status: int, _):
+        if status and status != DISCONNECTED and connection.cached:
+            print("cached gatt handles failed, discovering")
+            self._forget_handles(connection)
+            connection._ops = []
+            self._discover(connection)
+
+    def _ready(self, connection: Connection, status: int, _):
+        if status:
+            return
+        connection.state = READY
+        connection.attempts = 0
+        connection.device.on_ready(self._generic._ble, connection)
+
+    def _load_handles(self, connection: Connection) -> bool:
+        entry = self._cache.get(connection.device._mac.hex())
+        if entry is None:
+            return False
+        connection.start_handle, connection.end_handle, characteristics, connection.cccds = entry
+        connection.characteristics = [
+            (bluetooth.UUID(bytes.fromhex(uuid)), value_handle) for uuid, value_handle in characteristics
+        ]
+        connection.cached = True
+        return True
+
+    def _save_handles(self, connection: Connection):
+        if self._cache_path is None:
+            return
+        self._cache[connection.device._mac.hex()] = [
+            connection.start_handle,
+            connection.end_handle,
+            [[bytes(uuid).hex(), value_handle] for uuid, value_handle in connection.characteristics],
+            connection.cccds,
+        ]
+        self._write_cache()
+
+    def _forget_handles(self, connection: Connection):
+        if self._cache.pop(connection.device._mac.hex(), None) is not None:
+            self._write_cache()
+
+    def _write_cache(self):
+        try:
+            with open(self._cache_path, "w") as f:
+                json.dump(self._cache, f)
+        except OSError as e:
+            print(f"gatt cache not saved {e}")
+
+    def _on_disconnect(self, data):
+        conn_handle, addr_type, addr = data
+        if conn_handle == _NO_HANDLE:
+            connection = self._connecting
+            if connection is not None:
+                self._failed(connection)
+            return
+        connection = self._by_handle.pop(conn_handle, None)
+        if connection is None:
+            return
+        ready = connection.state == READY
+        connection.handle = None
+        connection.disconnects += 1
+        self._fail_ops(connection)
+        if ready:
+            connection.device.on_disconnected(self._generic._ble, connection)
+            # it worked before, so try again soon
+            connection.attempts = 0
+        if connection.state != IDLE:
+            self._backoff(connection)
+
+    def _on_service_result(self, data):
+        conn_handle, start_handle, end_handle, uuid = data
+        connection = self._by_handle[conn_handle]
+        connection.start_handle = start_handle
+        connection.end_handle = end_handle
+
+    def _on_service_done(self, data):
+        conn_handle, status = data
+        self._complete(self._by_handle.get(conn_handle), status, None)
+
+    def _on_characteristic_result(self, data):
+        conn_handle, def_handle, value_handle, properties, uuid = data
+        # uuid is only valid during the IRQ, on the ESP32 it lives on the stack
+        self._by_handle[conn_handle].characteristics.append((bluetooth.UUID(uuid), value_handle))
+
+    def _on_characteristic_done(self, data):
+        conn_handle, status = data
+        self._complete(self._by_handle.get(conn_handle), status, None)
+
+    def _on_descriptor_result(self, data):
+        conn_handle, dsc_handle, uuid = data
+        if uuid == _CCCD_UUID:
+            self._by_handle[conn_handle].cccds.append(dsc_handle)
+
+    def _on_descriptor_done(self, data):
+        conn_handle, status = data
+        self._complete(self._by_handle.get(conn_handle), status, None)
+
+    def _on_write_done(self, data):
+        conn_handle, value_handle, status = data
+        self._complete(self._by_handle.get(conn_handle), status, None)
+
+    def _on_notify(self, data):
+        conn_handle, value_handle, notify_data = data
+        connection = self._by_handle.get(conn_handle)
+        if connection is not None:
+            self._generic._queue_notify(connection.device, value_handle, notify_data)
+
+    def _on_read_result(self, data):
+        conn_handle, value_handle, char_data = data
+        connection = self._by_handle.get(conn_handle)
+        if connection is not None and connection._current is not None:
+            # the data is only valid during the event
+            connection._current[2] = bytes(char_data)
+
+    def _on_read_done(self, data):
+        conn_handle, value_handle, status = data
+        connection = self._by_handle.get(conn_handle)
+        if connection is not None and connection._current is not None:
+            self._complete(connection, status, connection._current[2])
+
+    def _on_connection_update(self, data):
+        # The remote device has updated connection parameters.
+        conn_handle, conn_interval, conn_latency, supervision_timeout, status = data
+        connection = self._by_handle.get(conn_handle)
+        if connection is not None:
+            # in units of 1.25 ms
+            connection.interval_us = conn_interval * 1250
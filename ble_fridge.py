@@ -1,10 +1,8 @@
 import struct
+import time
 import bluetooth
 from ble_common import SensorDevice
 
-_CCCD_UUID = bluetooth.UUID(0x2902)
-_NOTIFY_ENABLE = const(1)
-
 _SERVICE_UID = bluetooth.UUID(0x1234)
 _CMD_UID = bluetooth.UUID(0x1235)
 _NOTIFI_UID = bluetooth.UUID(0x1236)
@@ -16,61 +14,74 @@ def create_packet(data: bytes) -> bytes:
     return pkt
 
 class Fridge(SensorDevice):
-    """Alpicool/Vevor generic fridge"""
+    """Alpicool/Vevor generic fridge
+
+    Connected to by GenericBLE.connections, which enables the notifications
+    carrying the readings.
+
+    poll() queries the fridge when it is due. The interval drops to
+    min_poll_ms when the temperature or target changes and doubles up to
+    max_poll_ms with every unchanged reading. A notification the fridge
+    sends by itself counts as a reading too. No new query goes out while
+    one is unanswered for less than answer_ms.
+    """
 
-    def connect(self, ble):
-        ble.gap_connect(0x0, self._mac)
+    SERVICE_UUID = _SERVICE_UID
+
+    def __init__(self, mac: str, key: str, callback, min_poll_ms: int = 5000, max_poll_ms: int = 300000, answer_ms: int = 10000):
+        super().__init__(mac, key, callback)
+        self._connection = None
+        self.min_poll_ms = min_poll_ms
+        self.max_poll_ms = max_poll_ms
+        self.answer_ms = answer_ms
+        self.poll_ms = min_poll_ms
+        self._poll_at = 0
+        self._asked_at = None
+        self._reading = None
+        self.polls = 0
+        self.skipped = 0
+        self.unsolicited = 0
 
     def disconnect(self, ble):
-        ble.gap_disconnect(self._mac)
+        if self._connection is not None:
+            ble.gap_disconnect(self._connection.handle)
 
     def query(self, ble):
+        """Ask for the readings, they arrive as a notification"""
+        connection = self._connection
+        if connection is None:
+            return
         pkt = create_packet(struct.pack('B', 1))
-        ble.gattc_write(self._conn_handle, self._cmd_desc_handle, pkt, 0)
+        connection.write(connection.value_handle(_CMD_UID), pkt)
         print("ping")
 
-    def on_connected(self, ble, conn_handle, addr_type, addr):
-        self._conn_handle = conn_handle
-        ble.gattc_discover_services(conn_handle, _SERVICE_UID)
-
-    def on_service_result(self, ble, conn_handle, start_handle, end_handle, uuid):
-        self._start_handle = start_handle
-        self._end_handle = end_handle
+    def poll(self, ble):
+        """Query the fridge if it is due, call this regularly"""
+        if self._connection is None:
+            return
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._poll_at) < 0:
+            return
+        if self._asked_at is not None and time.ticks_diff(now, self._asked_at) < self.answer_ms:
+            self.skipped += 1
+            return
+        self.query(ble)
+        self.polls += 1
+        self._asked_at = now
+        self._poll_at = time.ticks_add(now, self.poll_ms)
 
-    def on_service_done(self, ble, conn_handle):
-        print("service_done")
-        ble.gattc_discover_characteristics(conn_handle, self._start_handle, self._end_handle)
-        print(f"discover start_handle {self._start_handle} end_handle: {self._end_handle}")
-        ble.gattc_discover_descriptors(conn_handle, self._start_handle, self._end_handle)
+    def on_ready(self, ble, connection):
+        if connection.value_handle(_CMD_UID) is None:
+            print("fridge has no command characteristic")
+            return
+        self._connection = connection
+        # ask right away and closely until the readings settle
+        self.poll_ms = self.min_poll_ms
+        self._poll_at = time.ticks_ms()
+        self._asked_at = None
 
-    def on_characteristic_result(self, ble, conn_handle, def_handle, value_handle, properties, uuid):
-        if uuid == _NOTIFI_UID:
-            self._def_handle = def_handle
-            self._notifi_value_handle = value_handle
-            self._properties = properties
-            print(f"NOTIFI_UID: {uuid} {conn_handle} {def_handle} {value_handle} {properties}")
-        elif uuid == _CMD_UID:
-            self._cmd_def_handle = def_handle
-            self._cmd_value_handle = value_handle
-            self._properties = properties
-            print(f"CMD_UID: {uuid} {conn_handle} {def_handle} {value_handle} {properties}")
-        else:
-            print(f"OTHER: {uuid} {value_handle} {properties}")
-
-    def on_characteristic_done(self, ble, conn_handle):
-        pass
-
-    def on_descriptor_result(self, ble, conn_handle, dsc_handle, uuid):
-        print(f"descriptor uuid {uuid}")
-        if uuid == _CCCD_UUID:
-            print(f"enable notify {dsc_handle} {uuid}")
-            ble.gattc_write(conn_handle, dsc_handle, struct.pack('<H', _NOTIFY_ENABLE), 1)
-        elif uuid == _CMD_UID:
-            print(f"settings cmd handle {uuid}")
-            self._cmd_desc_handle = dsc_handle
-
-    def on_descriptor_done(self, ble, conn_handle):
-        pass
+    def on_disconnected(self, ble, connection):
+        self._connection = None
 
     def on_notify(self, ble, value_handle, notify_data):
         if notify_data[:2] == b"\xFE\xFE":
@@ -79,5 +90,21 @@ class Fridge(SensorDevice):
             run_mode, target_temperature, current_temperature = struct.unpack_from('>xxbxbxxxxxxxxxb', notify_data, 4)
             run_mode = "E" if run_mode == 1 else "*"
             print(f"target: {target_temperature:.1f}C current: {current_temperature:.1f}C")
+            data = {"target_temperature": target_temperature, "current_temperature": current_temperature, "run_mode": run_mode}
+            self._adapt(target_temperature, current_temperature)
+            self.record(data)
             self._toggle = False if self._toggle else True
-            self.callback(self._toggle, {"target_temperature": target_temperature, "current_temperature": current_temperature, "run_mode": run_mode})
\ No newline at end of file
+            self.callback(self._toggle, data)
+
+    def _adapt(self, target_temperature: int, current_temperature: int):
+        """Poll often while the temperature moves, less and less while it does not"""
+        if self._asked_at is None:
+            self.unsolicited += 1
+        self._asked_at = None
+        reading = (target_temperature, current_temperature)
+        if reading != self._reading:
+            self.poll_ms = self.min_poll_ms
+        else:
+            self.poll_ms = min(self.poll_ms * 2, self.max_poll_ms)
+        self._reading = reading
+        self._poll_at = time.ticks_add(time.ticks_ms(), self.poll_ms)
@@ -5,6 +5,8 @@ from ble_common import SensorDevice
 class Hygrometer(SensorDevice):
     """Smart Hygrometer Widcomm, inc"""
 
+    ADV_PREFIX = b"\xF0\xFF\x15"
+
     def parse(self, data: str) -> dict:
         voltage, temperature_raw, humidity_raw = struct.unpack('HhH', data[19:])
         return self._return_if_changed(
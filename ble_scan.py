@@ -0,0 +1,214 @@
+import time
+from micropython import const
+
+# reports closer together than this belong to one advertising event
+_SAME_EVENT_MS = const(20)
+# longest guard a device gets after misses
+_MAX_GUARD_MS = const(5000)
+
+
+class ScanStats:
+    """What the scan scheduler learned about the advertising of a device"""
+
+    def __init__(self, guard_ms: int):
+        # learned advertising interval, 0 until two reports in one window
+        self.period_ms = 0
+        # interval between the last two reports in one window
+        self.observed_ms = 0
+        self.last_seen = None
+        self.guard_ms = guard_ms
+        self.seen = 0
+        self.misses = 0
+        self._cycle = -1
+
+
+class ScanScheduler:
+    """Scans only around the expected advertisements of the registered devices
+
+    Every cycle_ms each device with an ADV_PREFIX has to report once. The
+    scheduler learns the advertising interval of each device from reports
+    in one scan window, pauses scanning once every device reported in the
+    cycle and starts again guard_ms before the first device is expected in
+    the next cycle. Within a cycle it also pauses while no waiting device is
+    due. A device that does not show up within guard_ms of its expected
+    report counts as a miss and gets twice the guard from then on, every report
+    halves it again down to guard_ms. Devices keep the scan open until they
+    reported twice in it and their interval is known, at most learn_ms per
+    cycle. Otherwise a cycle scans at most max_window_ms.
+
+    tick() has to be called regularly, every 100 ms is plenty.
+    """
+
+    def __init__(
+        self,
+        ble,
+        cycle_ms: int = 10000,
+        guard_ms: int = 200,
+        max_window_ms: int = 5000,
+        learn_ms: int = 15000,
+        min_pause_ms: int = 300,
+        interval_us: int = 100000,
+        window_us: int = 100000,
+    ):
+        self._generic = ble
+        self.cycle_ms = cycle_ms
+        self.guard_ms = guard_ms
+        self.max_window_ms = max_window_ms
+        self.learn_ms = learn_ms
+        self.min_pause_ms = min_pause_ms
+        self.interval_us = interval_us
+        self.window_us = window_us
+        self.active = True
+        self.stats = {}
+        for device in ble._MACS.values():
+            if device.ADV_PREFIX is not None:
+                self.stats[device] = ScanStats(guard_ms)
+        now = time.ticks_ms()
+        self._cycle = 0
+        self._pending = len(self.stats)
+        self._cycle_start = now
+        self._cycle_scan_ms = 0
+        self._window_start = None
+        self._resume_at = now
+        self._next_cycle = False
+        self._since = now
+        self.scan_ms = 0
+        self.cycles = 0
+        ble.scheduler = self
+
+    @property
+    def duty(self) -> float:
+        """Share of the time spent scanning since the scheduler started"""
+        elapsed = time.ticks_diff(time.ticks_ms(), self._since)
+        scan_ms = self.scan_ms
+        if self._window_start is not None:
+            scan_ms += time.ticks_diff(time.ticks_ms(), self._window_start)
+        return scan_ms / elapsed if elapsed > 0 else 1
+
+    @property
+    def window_open(self) -> bool:
+        """True while the scheduler wants the radio scanning"""
+        return self._window_start is not None
+
+    def seen(self, device):
+        """Called from the BLE IRQ for every report of a registered device"""
+        stats = self.stats.get(device)
+        if stats is None:
+            return
+        now = time.ticks_ms()
+        last = stats.last_seen
+        if last is not None:
+            interval = time.ticks_diff(now, last)
+            if interval < _SAME_EVENT_MS:
+                return
+            if self._window_start is not None and time.ticks_diff(last, self._window_start) >= 0:
+                stats.observed_ms = interval
+                if not stats.period_ms:
+                    stats.period_ms = interval
+                elif interval < stats.period_ms * 3 // 2:
+                    # longer ones missed an advertisement in between
+                    stats.period_ms += (interval - stats.period_ms) // 4
+        stats.last_seen = now
+        stats.seen += 1
+        # until its interval is known a device keeps the scan open
+        if stats._cycle != self._cycle and stats.period_ms:
+            stats._cycle = self._cycle
+            stats.guard_ms = max(self.guard_ms, stats.guard_ms // 2)
+            self._pending -= 1
+
+    def tick(self):
+        if not self.active:
+            return
+        now = time.ticks_ms()
+        if self._window_start is None:
+            if time.ticks_diff(now, self._resume_at) >= 0:
+                self._resume(now)
+            return
+        if self._pending > 0:
+            self._check_misses(now)
+        if self._pending <= 0:
+            self._pause(now, self._next_cycle_at(now), True)
+            return
+        wait = self._wait_ms(now)
+        if wait is not None and wait >= self.min_pause_ms:
+            self._pause(now, time.ticks_add(now, wait), False)
+
+    def _resume(self, now: int):
+        generic = self._generic
+        if generic.connections._connecting is not None:
+            # connecting pauses scanning itself
+            return
+        if self._next_cycle:
+            self._next_cycle = False
+            self._cycle += 1
+            self.cycles += 1
+            self._pending = len(self.stats)
+            self._cycle_start = now
+            self._cycle_scan_ms = 0
+        generic.start(self.interval_us, self.window_us)
+        self._window_start = now
+
+    def _pause(self, now: int, resume_at: int, next_cycle: bool):
+        if self._generic.scanning:
+            self._generic.pause()
+        scanned = time.ticks_diff(now, self._window_start)
+        self.scan_ms += scanned
+        self._cycle_scan_ms += scanned
+        self._window_start = None
+        self._resume_at = resume_at
+        self._next_cycle = next_cycle
+
+    def _check_misses(self, now: int):
+        """Give up on devices that should have been seen in this window"""
+        scanned = self._cycle_scan_ms + time.ticks_diff(now, self._window_start)
+        for stats in self.stats.values():
+            if stats._cycle == self._cycle:
+                continue
+            if stats.period_ms:
+                expected = self._expected(stats, self._window_start)
+                missed = scanned > self.max_window_ms or time.ticks_diff(now, expected) > stats.guard_ms
+            else:
+                missed = scanned > self.learn_ms
+            if missed:
+                stats._cycle = self._cycle
+                stats.misses += 1
+                stats.guard_ms = min(stats.guard_ms * 2, _MAX_GUARD_MS)
+                self._pending -= 1
+
+    def _expected(self, stats: ScanStats, after: int) -> int:
+        """First expected report of a device at or after the ticks value after"""
+        periods = (time.ticks_diff(after, stats.last_seen) + stats.period_ms - 1) // stats.period_ms
+        return time.ticks_add(stats.last_seen, max(periods, 0) * stats.period_ms)
+
+    def _wait_ms(self, now: int):
+        """How long no device still waited for is due, None if one may come any time"""
+        wait = None
+        for stats in self.stats.values():
+            if stats._cycle == self._cycle:
+                continue
+            if not stats.period_ms or stats.last_seen is None:
+                return None
+            # a report up to guard_ms late is still waited for
+            expected = self._expected(stats, time.ticks_add(now, -stats.guard_ms))
+            until = time.ticks_diff(expected, now) - stats.guard_ms
+            if until <= 0:
+                return None
+            if wait is None or until < wait:
+                wait = until
+        return wait
+
+    def _next_cycle_at(self, now: int) -> int:
+        """guard_ms before the first report expected in the next cycle"""
+        start = time.ticks_add(self._cycle_start, self.cycle_ms)
+        if time.ticks_diff(start, now) < 0:
+            start = now
+        resume = None
+        for stats in self.stats.values():
+            if not stats.period_ms or stats.last_seen is None:
+                return start
+            at = time.ticks_add(self._expected(stats, start), -stats.guard_ms)
+            if resume is None or time.ticks_diff(at, resume) < 0:
+                resume = at
+        if resume is None or time.ticks_diff(resume, now) < 0:
+            return now
+        return resume
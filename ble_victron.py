@@ -1,119 +1,262 @@
-import struct
+import micropython
+from micropython import const
 from cryptolib import aes
-from ble_common import SensorDevice
+from ble_common import SensorDevice, copy_bytes
+
+# keystreams kept per device, Victron repeats a nonce until the values change
+_KEYSTREAMS = const(4)
 
 MODES = {
     0: "off",
+    1: "low",  # low power
+    2: "err",  # fault
     3: "blk",  # bulk
     4: "abs",  # absorb
     5: "flt",  # float
+    6: "sto",  # storage
+    7: "equ",  # equalize
+    9: "inv",  # inverting
+    11: "psu",  # power supply
+    245: "sta",  # starting up
+    246: "rep",  # repeated absorption
+    247: "equ",  # auto equalize
+    248: "bsf",  # battery safe
+    252: "ext",  # external control
 }
 
+# record type byte in the advertisement header
+_RECORD_TYPE = const(11)
 
-class VictronDevice(SensorDevice):
-    """A VictronDevice base class"""
-
-    def uncipher(self, adv_data: memoryview) -> str:
-        ctr = bytearray(adv_data[12:14])
-        ctr.extend(bytes(14))
-        ciphertext = bytearray(adv_data[15:])
-        if len(adv_data[15:]) < 16:
-            ciphertext.extend(bytes(16 - len(adv_data[15:])))
-        cipher = aes(self._key, 1)
-        cipher.encrypt(ctr, ctr)
-        cleartext = bytes(a ^ b for a, b in zip(ciphertext, ctr))
+
+@micropython.viper
+def _xor(dst, src, start: int, length: int):
+    d = ptr8(dst)
+    s = ptr8(src)
+    for i in range(length):
+        d[i] = d[i] ^ s[start + i]
+
+
+class AesCtr:
+    """AES-CTR decryption of Victron advertisements with the key set up once
+
+    The counter block is the 16 bit nonce from the advertisement followed by
+    zeros. Keystreams of the last few nonces are kept, and the ciphertext is
+    xored into a copy in place so no buffers are allocated.
+    """
+
+    def __init__(self, key: bytes):
+        self._cipher = aes(key, 1)
+        self._counter = bytearray(16)
+        self._keystreams = [bytearray(16) for _ in range(_KEYSTREAMS)]
+        self._nonces = [-1] * _KEYSTREAMS
+        self._next = 0
+        self._cleartext = bytearray(16)
+        self.keystream_hits = 0
+
+    def decrypt(self, adv_data: memoryview) -> bytearray:
+        """Decrypt the first block of the advertisement, the result is overwritten by the next call"""
+        nonce = adv_data[12] | adv_data[13] << 8
+        nonces = self._nonces
+        for slot in range(_KEYSTREAMS):
+            if nonces[slot] == nonce:
+                self.keystream_hits += 1
+                break
+        else:
+            slot = self._next
+            self._next = (slot + 1) % _KEYSTREAMS
+            counter = self._counter
+            counter[0] = adv_data[12]
+            counter[1] = adv_data[13]
+            self._cipher.encrypt(counter, self._keystreams[slot])
+            nonces[slot] = nonce
+
+        cleartext = self._cleartext
+        copy_bytes(cleartext, self._keystreams[slot], 0, 16)
+        _xor(cleartext, adv_data, 15, min(len(adv_data) - 15, 16))
         return cleartext
 
 
-class VictronSolar(VictronDevice):
-    """Victron MPPT Smart Solar charger"""
-
-    def parse(self, cleartext: str) -> dict:
-        (
-            state,
-            error,
-            battery_voltage,
-            battery_charging_current,
-            yield_today,
-            solar_power,
-            external_device_load,
-        ) = struct.unpack("BBhhHHH", cleartext)
-        mode = MODES[state]
-        battery_charging_current = battery_charging_current / 10
-        external_device_load = (
-            0 if external_device_load == 0x1FF else external_device_load
-        )
-        return self._return_if_changed(
-            {
-                "mode": mode,
-                "state": state,
-                "error": error,
-                "battery_voltage": battery_voltage,
-                "battery_charging_current": battery_charging_current,
-                "yield_today": yield_today,
-                "solar_power": solar_power,
-                "external_device_load": external_device_load,
-            }
-        )
-
-
-class VictronDCDC(VictronDevice):
-    """Victron Orion Smart DCDC charger"""
-
-    def parse(self, cleartext: str) -> dict:
-        state, error, input_voltage, output_voltage, off_reason = struct.unpack(
-            "BBhhI", cleartext
-        )
-        mode = MODES[state]
-        return self._return_if_changed(
-            {
-                "mode": mode,
-                "state": state,
-                "error": error,
-                "input_voltage": input_voltage,
-                "output_voltage": output_voltage,
-                "off_reason": off_reason,
-            }
-        )
-
-
-class VictronMonitor(VictronDevice):
-    """Victron Battery Monitor"""
-
-    def parse(self, cleartext: str) -> dict:
-        remaining_mins, voltage, alarm, aux = struct.unpack("HHHH", cleartext)
-        voltage = voltage / 100
-        consumed_ah = struct.unpack("H", bytes(cleartext[11:13]))[0] / 100
-        soc = float(
-            ((struct.unpack("H", bytes(cleartext[13:15]))[0] & 0x3FFF) >> 4) / 10
-        )
-        # get current
-        chunk = bytes(cleartext[8:11])
-        current = float(
-            (
-                (
-                    struct.unpack(
-                        "<i", chunk + (b"\ff" if chunk[2] == 0x80 else b"\x00")
-                    )[0]
-                    >> 2
-                )
-                / 1000
-            )
-        )
-        r_hours = remaining_mins // 60
-        r_mins = remaining_mins % 60
-        if r_hours > 99:
-            r_hours = 99
-            r_mins = 99
-        remaining_mins = 999 if remaining_mins > 999 else remaining_mins
-        return self._return_if_changed(
-            {
-                "remaining_mins": remaining_mins,
-                "r_hours": r_hours,
-                "r_mins": r_mins,
-                "voltage": voltage,
-                "consumed_ah": consumed_ah,
-                "current": current,
-                "soc": soc,
-            }
-        )
+@micropython.viper
+def _bits(data, start: int, count: int) -> uint:
+    """Little endian bit field of count bits at bit start, fields over 24 bits must be byte aligned"""
+    buf = ptr8(data)
+    index = start >> 3
+    shift = start & 7
+    value = uint(0)
+    n = 0
+    while n < count + shift:
+        value = value | (uint(buf[index]) << n)
+        index += 1
+        n += 8
+    value = value >> shift
+    if count < 32:
+        value = value & ((uint(1) << count) - 1)
+    return value
+
+
+def _mode(data: dict):
+    data["mode"] = MODES.get(data["state"], "???")
+
+
+def _remaining(data: dict):
+    remaining_mins = data["remaining_mins"]
+    r_hours = remaining_mins // 60
+    r_mins = remaining_mins % 60
+    if r_hours > 99:
+        r_hours = 99
+        r_mins = 99
+    data["r_hours"] = r_hours
+    data["r_mins"] = r_mins
+    data["remaining_mins"] = 999 if remaining_mins > 999 else remaining_mins
+
+
+class Record:
+    """Layout of a Victron instant readout record
+
+    Fields are (name, bits, signed, divisor, offset, not_available) with
+    everything after bits optional, laid out back to back from bit 0 of the
+    cleartext. A name of None skips the bits. The layout is compiled once into
+    a table of bit positions, a not available value decodes as 0.
+    """
+
+    def __init__(self, fields, post=None):
+        compiled = []
+        start = 0
+        for field in fields:
+            name, bits, signed, divisor, offset, na = field + (False, 1, 0, None)[len(field) - 2:]
+            if name is not None:
+                compiled.append((name, start, bits, 1 << (bits - 1) if signed else 0, divisor, offset, na))
+            start += bits
+        self._fields = tuple(compiled)
+        self._post = post
+
+    def decode(self, cleartext) -> dict:
+        data = {}
+        for name, start, bits, sign, divisor, offset, na in self._fields:
+            value = _bits(cleartext, start, bits)
+            if value == na:
+                value = 0
+            else:
+                if value & sign:
+                    value -= sign << 1
+                if divisor != 1:
+                    value = value / divisor
+                if offset:
+                    value += offset
+            data[name] = value
+        if self._post is not None:
+            self._post(data)
+        return data
+
+
+# fmt: off
+RECORDS = {
+    # solar charger
+    0x01: Record((
+        ("state", 8),
+        ("error", 8),
+        ("battery_voltage", 16, True, 100, 0, 0x7FFF),
+        ("battery_charging_current", 16, True, 10, 0, 0x7FFF),
+        ("yield_today", 16, False, 100, 0, 0xFFFF),
+        ("solar_power", 16, False, 1, 0, 0xFFFF),
+        ("external_device_load", 9, False, 10, 0, 0x1FF),
+    ), _mode),
+    # battery monitor
+    0x02: Record((
+        ("remaining_mins", 16),
+        ("voltage", 16, True, 100, 0, 0x7FFF),
+        ("alarm", 16),
+        ("aux", 16),
+        ("aux_input", 2),
+        ("current", 22, True, 1000),
+        ("consumed_ah", 20, False, 10, 0, 0xFFFFF),
+        ("soc", 10, False, 10, 0, 0x3FF),
+    ), _remaining),
+    # inverter
+    0x03: Record((
+        ("state", 8),
+        ("alarm", 16),
+        ("battery_voltage", 16, True, 100, 0, 0x7FFF),
+        ("ac_apparent_power", 16, False, 1, 0, 0xFFFF),
+        ("ac_voltage", 15, False, 100, 0, 0x7FFF),
+        ("ac_current", 11, False, 10, 0, 0x7FF),
+    ), _mode),
+    # dc-dc charger
+    0x04: Record((
+        ("state", 8),
+        ("error", 8),
+        ("input_voltage", 16, False, 100, 0, 0xFFFF),
+        ("output_voltage", 16, True, 100, 0, 0x7FFF),
+        ("off_reason", 32),
+    ), _mode),
+    # smart lithium battery
+    0x05: Record((
+        ("bms_flags", 32),
+        ("error", 16),
+        ("cell_1", 7, False, 100, 2.6, 0x7F),
+        ("cell_2", 7, False, 100, 2.6, 0x7F),
+        ("cell_3", 7, False, 100, 2.6, 0x7F),
+        ("cell_4", 7, False, 100, 2.6, 0x7F),
+        ("cell_5", 7, False, 100, 2.6, 0x7F),
+        ("cell_6", 7, False, 100, 2.6, 0x7F),
+        ("cell_7", 7, False, 100, 2.6, 0x7F),
+        ("cell_8", 7, False, 100, 2.6, 0x7F),
+        ("battery_voltage", 12, False, 100, 0, 0xFFF),
+        ("balancer_status", 4),
+        ("battery_temperature", 7, False, 1, -40, 0x7F),
+    )),
+    # ac charger
+    0x08: Record((
+        ("state", 8),
+        ("error", 8),
+        ("battery_voltage_1", 13, False, 100, 0, 0x1FFF),
+        ("battery_current_1", 11, False, 10, 0, 0x7FF),
+        ("battery_voltage_2", 13, False, 100, 0, 0x1FFF),
+        ("battery_current_2", 11, False, 10, 0, 0x7FF),
+        ("battery_voltage_3", 13, False, 100, 0, 0x1FFF),
+        ("battery_current_3", 11, False, 10, 0, 0x7FF),
+        ("temperature", 7, False, 1, -40, 0x7F),
+        ("ac_current", 9, False, 10, 0, 0x1FF),
+    ), _mode),
+}
+# fmt: on
+
+
+class VictronDevice(SensorDevice):
+    """A Victron device, the record layout is picked from the advertisement"""
+
+    ADV_PREFIX = b"\xE1\x02\x10"
+
+    def __init__(self, mac: str, key: str, callback):
+        super().__init__(mac, key, callback)
+        self._aes = AesCtr(key)
+        self._record_type = None
+        self.rejected = 0
+
+    def accept(self, adv_data: memoryview) -> bool:
+        """Reject short advertisements, ones encrypted with another key and repeats of the last one"""
+        if len(adv_data) < 16 or adv_data[14] != self._key[0]:
+            self.rejected += 1
+            return False
+        return super().accept(adv_data)
+
+    def uncipher(self, adv_data: memoryview) -> bytearray:
+        return self._aes.decrypt(adv_data)
+
+    def decode(self, adv_data: memoryview) -> dict:
+        self._record_type = adv_data[_RECORD_TYPE]
+        return self.parse(self.uncipher(adv_data))
+
+    def parse(self, cleartext: bytearray) -> dict:
+        record = RECORDS.get(self._record_type)
+        if record is None:
+            return None
+        return self._return_if_changed(record.decode(cleartext))
+
+
+# kept so existing setups keep working, the record type is now read from the advertisement
+VictronSolar = VictronDevice
+VictronDCDC = VictronDevice
+VictronMonitor = VictronDevice
+
+
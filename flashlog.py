@@ -0,0 +1,246 @@
+import struct
+from array import array
+from micropython import const
+
+_MAGIC = b"VLOG"
+# magic, sequence number, timestamp of the first record, bytes used, records
+_HEADER = "<4sIIHH"
+_HEADER_SIZE = const(16)
+
+
+def _put_varint(buffer, pos: int, value: int) -> int:
+    while value > 0x7F:
+        buffer[pos] = (value & 0x7F) | 0x80
+        value >>= 7
+        pos += 1
+    buffer[pos] = value
+    return pos + 1
+
+
+def _get_varint(buffer, pos: int):
+    value = 0
+    shift = 0
+    while True:
+        b = buffer[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+class FlashLog:
+    """Append-only log of readings in a file of fixed size blocks
+
+    fields is a sequence of (name, scale), values are stored as
+    round(value * scale). A record holds the seconds since the record before
+    it, a bit mask of the fields present and per present field the change
+    since its last value, all as varints. Every block starts from its own
+    header timestamp and zero values, so it can be decoded on its own.
+
+    add() only encodes into a RAM block and never does I/O. A full block is
+    handed to flush(), which writes it in one go, and sync() also writes the
+    block being filled. While flush() has not written the last full block
+    yet, records that need a new block are dropped and counted in overruns. The file holds blocks slots that are reused oldest first. Opening
+    a log only reads the block headers and decodes the newest block, the
+    headers also serve as the index read() seeks in. Seeking assumes the
+    clock does not go backwards between records.
+
+    At most one record is kept per interval seconds.
+    """
+
+    def __init__(self, path: str, fields, blocks: int = 24, block_size: int = 4096, interval: int = 60):
+        self.path = path
+        self.names = tuple(f[0] for f in fields)
+        self._scales = tuple(f[1] for f in fields)
+        self.blocks = blocks
+        self.block_size = block_size
+        self.interval = interval
+        self.records = 0
+        self.blocks_written = 0
+        self.overruns = 0
+        # sequence number, 0 for an unused slot, and first timestamp per slot
+        self._seqs = array("I", bytes(4 * blocks))
+        self._times = array("I", bytes(4 * blocks))
+        self._buffer = bytearray(block_size)
+        self._pending = bytearray(block_size)
+        self._pending_slot = -1
+        self._values = array("i", bytes(4 * len(self.names)))
+        self._new = array("i", bytes(4 * len(self.names)))
+        self._max_record = 10 + 5 * len(self.names)
+        self._slot = -1
+        self._seq = 0
+        self._used = 0
+        self._count = 0
+        self._last_time = None
+        self._recover()
+
+    def add(self, timestamp: int, data: dict):
+        """Add the readings in data taken at timestamp, in seconds"""
+        if self._last_time is not None and 0 <= timestamp - self._last_time < self.interval:
+            return
+        new = self._new
+        mask = 0
+        for i, name in enumerate(self.names):
+            value = data.get(name)
+            if value is not None:
+                new[i] = int(round(value * self._scales[i]))
+                mask |= 1 << i
+        if not mask:
+            return
+        if self._slot < 0 or self._used + self._max_record > self.block_size:
+            if self._pending_slot >= 0:
+                # flush() fell behind, the full block waiting for it must not be overwritten
+                self.overruns += 1
+                return
+            self._new_block(timestamp)
+        buffer = self._buffer
+        values = self._values
+        pos = self._used
+        pos = _put_varint(buffer, pos, _zigzag(timestamp - self._last_time) if self._count else 0)
+        pos = _put_varint(buffer, pos, mask)
+        for i in range(len(values)):
+            if mask & (1 << i):
+                pos = _put_varint(buffer, pos, _zigzag(new[i] - values[i]))
+                values[i] = new[i]
+        self._used = pos
+        self._count += 1
+        self._last_time = timestamp
+        self.records += 1
+
+    def flush(self):
+        """Write a full block, if there is one"""
+        if self._pending_slot >= 0:
+            self._write(self._pending_slot, self._pending)
+            self._pending_slot = -1
+
+    def sync(self):
+        """Write everything added so far, also the block still being filled"""
+        self.flush()
+        if self._count:
+            self._seal(self._buffer, self._seq, self._times[self._slot], self._used, self._count)
+            self._write(self._slot, self._buffer)
+
+    def read(self, since: int = 0):
+        """Yield (timestamp, {name: value}) for the records from since on, oldest first"""
+        self.flush()
+        order = self._order()
+        # last block starting at or before since
+        low = 0
+        high = len(order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._times[order[middle]] <= since:
+                low = middle + 1
+            else:
+                high = middle
+        start = low - 1 if low else 0
+        block = None
+        for slot in order[start:]:
+            if slot == self._slot:
+                records = self._decode(self._buffer, self._times[slot], self._used)
+            else:
+                if block is None:
+                    block = bytearray(self.block_size)
+                with open(self.path, "rb") as f:
+                    f.seek(slot * self.block_size)
+                    f.readinto(block)
+                _, _, timestamp, used, _ = struct.unpack_from(_HEADER, block)
+                records = self._decode(block, timestamp, used)
+            for timestamp, mask, values in records:
+                if timestamp >= since:
+                    yield timestamp, {
+                        name: values[i] / self._scales[i] for i, name in enumerate(self.names) if mask & (1 << i)
+                    }
+
+    def last(self, seconds: int):
+        """Yield the records of the last seconds before the newest one"""
+        if self._last_time is None:
+            return iter(())
+        return self.read(max(self._last_time - seconds, 0))
+
+    def _order(self):
+        """Used slots, oldest first"""
+        seqs = self._seqs
+        return sorted((slot for slot in range(self.blocks) if seqs[slot]), key=lambda slot: seqs[slot])
+
+    def _new_block(self, timestamp: int):
+        if self._slot >= 0:
+            self._seal(self._buffer, self._seq, self._times[self._slot], self._used, self._count)
+            self._buffer, self._pending = self._pending, self._buffer
+            self._pending_slot = self._slot
+        self._slot = (self._slot + 1) % self.blocks
+        self._seq += 1
+        self._seqs[self._slot] = self._seq
+        self._times[self._slot] = timestamp
+        self._used = _HEADER_SIZE
+        self._count = 0
+        values = self._values
+        for i in range(len(values)):
+            values[i] = 0
+
+    def _decode(self, block, timestamp: int, used: int):
+        """Yield (timestamp, mask, values) per record, values is reused"""
+        values = array("i", bytes(4 * len(self.names)))
+        pos = _HEADER_SIZE
+        first = True
+        while pos < used:
+            delta, pos = _get_varint(block, pos)
+            if not first:
+                timestamp += _unzigzag(delta)
+            first = False
+            mask, pos = _get_varint(block, pos)
+            for i in range(len(values)):
+                if mask & (1 << i):
+                    delta, pos = _get_varint(block, pos)
+                    values[i] += _unzigzag(delta)
+            yield timestamp, mask, values
+
+    @staticmethod
+    def _seal(block, seq: int, timestamp: int, used: int, count: int):
+        struct.pack_into(_HEADER, block, 0, _MAGIC, seq, timestamp, used, count)
+
+    def _write(self, slot: int, block):
+        with open(self.path, "r+b") as f:
+            f.seek(slot * self.block_size)
+            f.write(block)
+        self.blocks_written += 1
+
+    def _recover(self):
+        """Read the block headers and continue in the newest block"""
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            open(self.path, "wb").close()
+            return
+        header = bytearray(_HEADER_SIZE)
+        newest = -1
+        with f:
+            for slot in range(self.blocks):
+                f.seek(slot * self.block_size)
+                if f.readinto(header) < _HEADER_SIZE:
+                    break
+                magic, seq, timestamp, _, _ = struct.unpack(_HEADER, header)
+                if magic == _MAGIC and seq:
+                    self._seqs[slot] = seq
+                    self._times[slot] = timestamp
+                    if newest < 0 or seq > self._seqs[newest]:
+                        newest = slot
+            if newest < 0:
+                return
+            f.seek(newest * self.block_size)
+            f.readinto(self._buffer)
+        _, self._seq, timestamp, self._used, self._count = struct.unpack_from(_HEADER, self._buffer)
+        self._slot = newest
+        for timestamp, _, values in self._decode(self._buffer, timestamp, self._used):
+            self._last_time = timestamp
+            for i in range(len(values)):
+                self._values[i] = values[i]
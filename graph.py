@@ -0,0 +1,140 @@
+import struct
+from array import array
+from math import ceil, floor, log10
+from st7789py import BLACK, YELLOW
+
+_NAN = float("nan")
+
+
+def _nice_range(low: float, high: float):
+    """Round low down and high up to a step of 1, 2 or 5 times a power of ten"""
+    span = high - low
+    if span <= 0:
+        span = abs(high) or 1
+    step = 10 ** floor(log10(span / 2))
+    for multiple in (1, 2, 5, 10):
+        if span / (step * multiple) <= 2:
+            step *= multiple
+            break
+    low = floor(low / step) * step
+    high = ceil(high / step) * step
+    if high == low:
+        high = low + step
+    return low, high
+
+
+class Graph:
+    """Strip chart in a hardware scrolled band of columns
+
+    The graph covers width columns from x over the full height of a
+    landscape display, everything in those columns scrolls. A buffered
+    display leaves them out when it shows its framebuffer, so drawing there
+    through the framebuffer is never shown. A sample draws one 1 pixel
+    column straight to the display memory and moves the scroll pointer, so
+    the plot is never redrawn while the range stays the same.
+    With minimum or maximum left out that end of the range follows the
+    samples, and the plot is redrawn when the rounded range changes. It
+    grows right away and shrinks when the samples fit in half of it.
+    """
+
+    def __init__(self, display, x: int, width: int, color=YELLOW, background=BLACK, minimum=None, maximum=None):
+        if not display.scrolls_x:
+            raise ValueError("Graph needs a landscape rotation")
+        self.display = display
+        self.x = x
+        self.width = width
+        self.height = display.height
+        self.minimum = minimum
+        self.maximum = maximum
+        self.low = 0 if minimum is None else minimum
+        self.high = 1 if maximum is None else maximum
+        self.columns_drawn = 0
+        self.redraws = 0
+        self._values = array("f", [_NAN] * width)
+        self._next = 0
+        # lowest and highest sample shown, None when they have to be looked up
+        self._data_low = None
+        self._data_high = None
+        encode = "<H" if display.needs_swap else ">H"
+        self._background = bytes(struct.pack(encode, background) * self.height)
+        self._foreground = bytes(struct.pack(encode, color) * self.height)
+        self._column = bytearray(self.height * 2)
+        self._column_view = memoryview(self._column)
+        display.scroll_area(x, width)
+        self.redraw()
+
+    def add(self, value: float):
+        """Add a sample at the right edge, the oldest one scrolls out"""
+        position = self._next
+        old = self._values[position]
+        self._values[position] = value
+        # compare as stored, the array keeps single precision floats
+        value = self._values[position]
+        if old == self._data_low or old == self._data_high:
+            self._data_low = self._data_high = None
+        elif self._data_low is not None:
+            if value < self._data_low:
+                self._data_low = value
+            if value > self._data_high:
+                self._data_high = value
+        self._next = (position + 1) % self.width
+        if self._rescale():
+            self.redraw()
+            return
+        self._draw(position, value, self._values[position - 1])
+        self.display.scroll(self._next)
+
+    def redraw(self):
+        """Draw every column again, oldest sample at the left edge"""
+        values = self._values
+        for position in range(self.width):
+            previous = _NAN if position == self._next else values[position - 1]
+            self._draw(position, values[position], previous)
+        self.display.scroll(self._next)
+        self.redraws += 1
+
+    def _rescale(self) -> bool:
+        if self.minimum is not None and self.maximum is not None:
+            return False
+        if self._data_low is None:
+            low = high = None
+            for value in self._values:
+                if value == value:
+                    if low is None or value < low:
+                        low = value
+                    if high is None or value > high:
+                        high = value
+            if low is None:
+                return False
+            self._data_low = low
+            self._data_high = high
+        low, high = _nice_range(
+            self._data_low if self.minimum is None else self.minimum,
+            self._data_high if self.maximum is None else self.maximum,
+        )
+        if low < self.low or high > self.high or (high - low) * 2 <= self.high - self.low:
+            self.low = low
+            self.high = high
+            return True
+        return False
+
+    def _y(self, value: float) -> int:
+        bottom = self.height - 1
+        y = bottom - int((value - self.low) * bottom / (self.high - self.low))
+        return 0 if y < 0 else bottom if y > bottom else y
+
+    def _draw(self, position: int, value: float, previous: float):
+        column = self._column_view
+        column[:] = self._background
+        if value == value:
+            top = bottom = self._y(value)
+            if previous == previous:
+                # join the sample to the one before it
+                y = self._y(previous)
+                if y < top:
+                    top = y
+                elif y > bottom:
+                    bottom = y
+            column[top * 2 : (bottom + 1) * 2] = self._foreground[: (bottom - top + 1) * 2]
+        self.display.blit_panel(self._column, self.x + position, 0, 1, self.height)
+        self.columns_drawn += 1
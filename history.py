@@ -0,0 +1,130 @@
+from array import array
+from micropython import const
+
+_NA = const(-32768)
+_MIN_H = const(-32767)
+_MAX_H = const(32767)
+
+# (seconds per sample, samples kept): 5 min of seconds, 24 h of minutes and
+# 48 h of quarters
+LEVELS = ((1, 300), (60, 1440), (900, 192))
+
+
+class History:
+    """Fixed size history of some numeric fields of a device
+
+    fields is a sequence of (name, scale) or (name, scale, typecode), values
+    are kept as round(value * scale) in an array("h") per field and level,
+    or array("i") for typecode "i". Every level is a ring with one shared
+    timestamp column and averages the samples in each of its periods, so a
+    sample costs the same whatever the history length and nothing is
+    allocated once the history is created. A field missing from a sample is
+    left out of the average, a period without it is None.
+    """
+
+    def __init__(self, fields, levels=LEVELS):
+        self.names = tuple(f[0] for f in fields)
+        self._scales = tuple(f[1] for f in fields)
+        self._typecodes = tuple(f[2] if len(f) > 2 else "h" for f in fields)
+        self.periods = tuple(period for period, _ in levels)
+        self.sizes = tuple(size for _, size in levels)
+        self._times = [array("i", bytes(4 * size)) for _, size in levels]
+        self._columns = [
+            [array(typecode, bytes(4 * size if typecode == "i" else 2 * size)) for typecode in self._typecodes]
+            for _, size in levels
+        ]
+        self._next = array("i", bytes(4 * len(levels)))
+        self.counts = array("i", bytes(4 * len(levels)))
+        # running sums of the period each level is collecting
+        self._period = array("i", [-1] * len(levels))
+        self._sums = [array("i", bytes(4 * len(fields))) for _ in levels]
+        self._samples = [array("i", bytes(4 * len(fields))) for _ in levels]
+        self._values = array("i", bytes(4 * len(fields)))
+        self._present = bytearray(len(fields))
+
+    @property
+    def footprint(self) -> int:
+        """Bytes held by the rings"""
+        total = 0
+        for size in self.sizes:
+            total += 4 * size
+            for typecode in self._typecodes:
+                total += (4 if typecode == "i" else 2) * size
+        return total
+
+    def add(self, timestamp: int, data: dict):
+        """Add the values of data taken at timestamp, in seconds"""
+        values = self._values
+        present = self._present
+        scales = self._scales
+        for i, name in enumerate(self.names):
+            value = data.get(name)
+            if value is None:
+                present[i] = 0
+            else:
+                values[i] = int(round(value * scales[i]))
+                present[i] = 1
+        for level, period in enumerate(self.periods):
+            start = timestamp - timestamp % period
+            if start != self._period[level]:
+                if self._period[level] >= 0:
+                    self._commit(level)
+                self._period[level] = start
+            sums = self._sums[level]
+            samples = self._samples[level]
+            for i in range(len(values)):
+                if present[i]:
+                    sums[i] += values[i]
+                    samples[i] += 1
+
+    def flush(self):
+        """Store the periods still being collected"""
+        for level in range(len(self.periods)):
+            if self._period[level] >= 0:
+                self._commit(level)
+                self._period[level] = -1
+
+    def _commit(self, level: int):
+        index = self._next[level]
+        self._times[level][index] = self._period[level]
+        columns = self._columns[level]
+        sums = self._sums[level]
+        samples = self._samples[level]
+        for i in range(len(sums)):
+            if samples[i]:
+                value = sums[i] // samples[i]
+                if self._typecodes[i] == "h":
+                    value = _MIN_H if value < _MIN_H else _MAX_H if value > _MAX_H else value
+                columns[i][index] = value
+            else:
+                columns[i][index] = _NA
+            sums[i] = 0
+            samples[i] = 0
+        self._next[level] = (index + 1) % self.sizes[level]
+        if self.counts[level] < self.sizes[level]:
+            self.counts[level] += 1
+
+    def series(self, name: str, level: int = 0, count: int = 0):
+        """Yield (timestamp, value) of the last count periods of a level, oldest first
+
+        count 0 yields everything kept.
+        """
+        column = self._columns[level][self.names.index(name)]
+        scale = self._scales[self.names.index(name)]
+        times = self._times[level]
+        size = self.sizes[level]
+        kept = self.counts[level]
+        if count <= 0 or count > kept:
+            count = kept
+        index = (self._next[level] - count) % size
+        for _ in range(count):
+            value = column[index]
+            yield times[index], None if value == _NA else value / scale
+            index = (index + 1) % size
+
+    def last(self, name: str, level: int = 0):
+        """The latest stored value of a level, None if there is none"""
+        if not self.counts[level]:
+            return None
+        value = self._columns[level][self.names.index(name)][(self._next[level] - 1) % self.sizes[level]]
+        return None if value == _NA else value / self._scales[self.names.index(name)]
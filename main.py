@@ -1,12 +1,18 @@
 import machine
-import time
 import micropython
 import vga1_16x32 as font
 from st7789py import ST7789, BLACK, WHITE
+from textgrid import TextGrid
 from ble_common import GenericBLE
-from ble_victron import VictronSolar, VictronDCDC, VictronMonitor
+from ble_victron import VictronDevice
 from ble_hygrometer import Hygrometer
 from ble_fridge import Fridge
+from ble_scan import ScanScheduler
+from runtime import Runtime
+from history import History
+from flashlog import FlashLog
+from powersave import DisplayPower
+from render import Renderer
 
 # allocate buffer for irq exceptions
 # micropython.alloc_emergency_exception_buf(100)
@@ -29,45 +35,63 @@ lcd = ST7789(
     cs=machine.Pin(5, machine.Pin.OUT),
     backlight=machine.Pin(27, machine.Pin.OUT),
     rotation=rotation,
+    buffered=True,
+    glyph_cache=16 * 1024,
 )
 lcd.fill(BLACK)
+lcd.show()
 # set backlight off to preserve battery
 backlight = machine.PWM(lcd.backlight)
 backlight.freq(750)
-backlight.duty(512)
+# dim after 30 s and sleep after 2 min without a button press or a reading that matters
+display_power = DisplayPower(lcd, backlight, dim_ms=30000, off_ms=120000, bright=512)
+# draw what the devices reported at most 10 times a second
+renderer = Renderer(lcd, fps=10)
 
 
 # generic display function display is about 14 chars wide and 3 lines high with 16x32 monospace font
-def display_func(text_format, offset_y, offset_x=0):
-    def display_func_inner(toggle, data):
+# alarms maps fields to the change that wakes the display, see DisplayPower.watcher
+def display_func(text_format, offset_y, offset_x=0, alarms=None):
+    grid = TextGrid(lcd, font, 6 + offset_x, offset_y, (lcd.width - 6 - offset_x) // font.WIDTH)
+    watch = display_power.watcher(alarms) if alarms else None
+
+    def draw(update):
+        toggle, data = update
         if data:
-            lcd.text(font, text_format.format(**data), 6 + offset_x, offset_y)
+            grid.text(text_format.format(**data))
         # show data has been received
-        if toggle:
-            lcd.vline(0, offset_y, 32, WHITE)
-            lcd.vline(1, offset_y, 32, WHITE)
-        else:
-            lcd.vline(0, offset_y, 32, BLACK)
-            lcd.vline(1, offset_y, 32, BLACK)
+        lcd.fill_rect(0, offset_y, 2, 32, WHITE if toggle else BLACK)
+
+    widget = renderer.widget(draw)
+
+    def display_func_inner(toggle, data):
+        if data:
+            if watch is not None:
+                watch(data)
+        elif widget.dirty:
+            # unchanged readings only blink, keep the text still waiting to be drawn
+            data = widget.data[1]
+        renderer.update(widget, (toggle, data))
 
     return display_func_inner
 
 
 # setup Victron devices, you can find mac and encryption keys in the victron mobile app
-solar = VictronSolar(
+solar = VictronDevice(
     mac=b"\xee\xc0\xb8\x8c\x53\xf4",
     key=b"\x10\x63\x76\x13\x6f\xf4\xd0\x8c\x6a\x01\x99\x15\xfd\xee\xc0\x11",
     callback=display_func(
         text_format="{mode:<3}  {battery_charging_current:>4.1f} {solar_power:>3.0f}W",
         offset_y=8,
+        alarms={"mode": 0},
     ),
 )
-dcdc = VictronDCDC(
+dcdc = VictronDevice(
     mac=b"\xcd\x73\xa1\x0f\x95\x99",
     key=b"\x9f\xea\xf4\x0c\x53\xdb\xd0\xff\x1c\x26\xb9\xba\xe6\xf3\xb7\xce",
     callback=display_func(text_format="{mode:<3}", offset_y=52),
 )
-# monitor = VictronMonitor(
+# monitor = VictronDevice(
 #     mac=b"\xc7\x83\xfd\xca\xca\x06",
 #     key=b"\xe3\x39\xd2\xf5\x2c\xed\x10\x2f\x1c\x2c\xe9\x0e\x94\xa1\x70\x09",
 #     callback=display_func(
@@ -77,36 +101,83 @@ dcdc = VictronDCDC(
 hygrometer = Hygrometer(
     mac=b"\x62\x81\x00\x00\x07\x54",
     key=None,
-    callback=display_func(text_format="{temperature:>2.0f}C {humidity:>2.0f}%", offset_y=96)
+    callback=display_func(
+        text_format="{temperature:>2.0f}C {humidity:>2.0f}%", offset_y=96, alarms={"temperature": 3}
+    )
 )
 
 fridge = Fridge(
     mac=b"\x2E\x4F\x29\x48\x66\x7F",
     key=None,
-    callback=display_func(text_format="{run_mode}{current_temperature:>2.1f}C", offset_y=96, offset_x=130)
+    callback=display_func(
+        text_format="{run_mode}{current_temperature:>2.1f}C",
+        offset_y=96,
+        offset_x=130,
+        alarms={"current_temperature": 3},
+    )
 )
 
+# keep trends of the interesting readings, 24 h of minutes and 48 h of quarters
+solar.history = History((("solar_power", 1), ("battery_voltage", 100), ("battery_charging_current", 10)))
+hygrometer.history = History((("temperature", 10), ("humidity", 10)))
+fridge.history = History((("current_temperature", 1),))
+# and a minute by minute log on flash that survives the daily reboot
+solar.log = FlashLog("/solar.log", (("solar_power", 1), ("battery_voltage", 100), ("battery_charging_current", 10)))
+hygrometer.log = FlashLog("/hygrometer.log", (("temperature", 10), ("humidity", 10)))
+fridge.log = FlashLog("/fridge.log", (("current_temperature", 1),))
+logs = (solar.log, hygrometer.log, fridge.log)
+
+
+def flush_logs():
+    for log in logs:
+        log.flush()
+
+
+def sync_logs():
+    for log in logs:
+        log.sync()
+
+
 # setup Victron Bluetooth scanner
 ble = GenericBLE()
+# reconnect without discovering the services again
+ble.connections.use_cache("/gatt.json")
 ble.register_device(solar)
 ble.register_device(dcdc)
 ble.register_device(hygrometer)
+# the fridge is connected to, and reconnected after losing it, by ble.connections
 ble.register_device(fridge)
-fridge.connect(ble._ble)
-# setup timer to query fridge every 30 seconds
-fridge_timer = machine.Timer(1, period=30000, callback=lambda _: fridge.query(ble._ble))
-time.sleep(4)
 ble.start()
+# only scan around the expected advertisements, every device once per 10 s
+scheduler = ScanScheduler(ble, cycle_ms=10000)
 
 
 # setup buttons
 def handle_btn_m5(p):
+    # the first press only wakes the display
+    if display_power.activity():
+        return
     print("btn_m5 pressed")
-    victron.stop()
+    ble.stop()
 
 
 B_M5 = machine.Pin(37, mode=machine.Pin.IN)
-B_M5.irq(handler=handle_btn_m5, trigger=machine.Pin.IRQ_FALLING)
+
+runtime = Runtime()
+# decode advertisements in a task so drawing never blocks the bluetooth irq
+runtime.ble(ble)
+runtime.every(100, scheduler.tick)
+# draw and send what the devices reported to the lcd
+runtime.add(renderer.run())
+# query the fridge often while its temperature moves, rarely while it is steady
+runtime.every(1000, fridge.poll, ble._ble)
+runtime.button(B_M5, handle_btn_m5)
+# wakes the display up shortly after a button press or an alarm
+runtime.every(200, display_power.tick)
+# write full log blocks soon, the ones being filled every 15 minutes
+runtime.every(10000, flush_logs)
+runtime.every(15 * 60 * 1000, sync_logs)
 
 # after 24 hours program exit and watchdog reboot
-time.sleep(60 * 60 * 24)
+runtime.run(60 * 60 * 24)
+sync_logs()
@@ -0,0 +1,103 @@
+import time
+
+
+class DisplayPower:
+    """Dims the backlight and puts the panel to sleep while nobody looks
+
+    After dim_ms without activity the backlight goes down to the dim duty,
+    after off_ms the backlight goes off and the panel sleeps. activity()
+    brings the display back, and so does a reading passed to a watcher()
+    that moved by at least its threshold. They only note the wake up, so
+    they are safe to call from an IRQ, tick() talks to the display and the
+    backlight. The panel keeps its memory while it
+    sleeps and a buffered display sends everything drawn meanwhile in one
+    show() on waking up, so nothing has to be redrawn.
+
+    panel_on_ms, backlight_on_ms and backlight_full_ms count the time the
+    panel was awake, the backlight was on at any duty and the backlight on
+    time scaled to full duty, from which the energy saved can be estimated.
+    tick() has to be called regularly, how often sets how soon the display
+    wakes up.
+    """
+
+    def __init__(self, display, backlight, dim_ms: int = 30000, off_ms: int = 120000, bright: int = 512, dim: int = 64):
+        self.display = display
+        self.backlight = backlight
+        self.dim_ms = dim_ms
+        self.off_ms = off_ms
+        self.bright = bright
+        self.dim = dim
+        self.duty = bright
+        self.panel_on_ms = 0
+        self.backlight_on_ms = 0
+        self.backlight_full_ms = 0
+        self.wakeups = 0
+        self._wake = False
+        now = time.ticks_ms()
+        self._active = now
+        self._counted = now
+        backlight.duty(bright)
+
+    def activity(self) -> bool:
+        """Restart the idle time and have the next tick() bring the display back, True if it was dimmed or asleep"""
+        self._active = time.ticks_ms()
+        if self.duty == self.bright:
+            return False
+        self._wake = True
+        return True
+
+    def watcher(self, thresholds: dict):
+        """Return a function that counts a reading of one device as activity when a
+        field moved by at least its threshold
+
+        thresholds maps field names to the change that matters, 0 for any
+        change, which also works for text like a charger mode.
+        """
+        # last value per field that counted as activity, small steps add up until they matter
+        values = {}
+
+        def watch(data: dict):
+            for name, threshold in thresholds.items():
+                value = data.get(name)
+                if value is None:
+                    continue
+                last = values.get(name)
+                if last is None:
+                    values[name] = value
+                elif (value != last) if threshold == 0 else (abs(value - last) >= threshold):
+                    values[name] = value
+                    self.activity()
+
+        return watch
+
+    def tick(self):
+        now = time.ticks_ms()
+        self._count(now)
+        if self._wake:
+            self._wake = False
+            if self.display.sleeping:
+                self.display.sleep_mode(False)
+                self.wakeups += 1
+            self._set_duty(self.bright)
+            return
+        idle = time.ticks_diff(now, self._active)
+        if idle >= self.off_ms:
+            if not self.display.sleeping:
+                self._set_duty(0)
+                self.display.sleep_mode(True)
+        elif idle >= self.dim_ms:
+            if self.duty > self.dim:
+                self._set_duty(self.dim)
+
+    def _set_duty(self, duty: int):
+        self.duty = duty
+        self.backlight.duty(duty)
+
+    def _count(self, now: int):
+        elapsed = time.ticks_diff(now, self._counted)
+        self._counted = now
+        if not self.display.sleeping:
+            self.panel_on_ms += elapsed
+        if self.duty:
+            self.backlight_on_ms += elapsed
+            self.backlight_full_ms += elapsed * self.duty // 1023
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+
+class Widget:
+    """Part of the screen drawn by draw(data) with the latest data it was given"""
+
+    def __init__(self, draw):
+        self.draw = draw
+        self.data = None
+        self.dirty = False
+
+
+class Renderer:
+    """Draws the changed widgets in frames, at most fps of them per second
+
+    Device callbacks only hand their data to update(), which marks the
+    widget dirty. A frame draws every dirty widget once with its latest data
+    and sends all of it with one show(), so a burst of reports costs one
+    frame and data replaced before a frame drew it is never drawn. No frame
+    is drawn while nothing changed.
+
+    frames_skipped counts the frame slots lost to frames running longer than
+    a period, coalesced the updates that replaced data not drawn yet.
+    """
+
+    def __init__(self, display, fps: int = 10):
+        self.display = display
+        self.period_ms = 1000 // fps
+        self.widgets = []
+        self._dirty = False
+        self.frames = 0
+        self.frames_skipped = 0
+        self.updates = 0
+        self.coalesced = 0
+        self.frame_ms = 0
+        self.max_frame_ms = 0
+        self.total_frame_ms = 0
+
+    @property
+    def average_frame_ms(self) -> float:
+        return self.total_frame_ms / self.frames if self.frames else 0
+
+    @property
+    def coalesced_per_frame(self) -> float:
+        return self.coalesced / self.frames if self.frames else 0
+
+    def widget(self, draw) -> Widget:
+        """Add a widget drawn by draw(data)"""
+        widget = Widget(draw)
+        self.widgets.append(widget)
+        return widget
+
+    def update(self, widget: Widget, data):
+        """Draw widget with data in the next frame"""
+        if widget.dirty:
+            self.coalesced += 1
+        widget.data = data
+        widget.dirty = True
+        self._dirty = True
+        self.updates += 1
+
+    def frame(self):
+        """Draw the dirty widgets and send them to the display"""
+        if not self._dirty:
+            return
+        start = time.ticks_ms()
+        self._dirty = False
+        for widget in self.widgets:
+            if widget.dirty:
+                widget.dirty = False
+                try:
+                    widget.draw(widget.data)
+                except Exception as e:
+                    # one bad reading must not stop the frames of the other widgets
+                    print(f"drawing {widget.draw} failed {e!r}")
+        self.display.show()
+        elapsed = time.ticks_diff(time.ticks_ms(), start)
+        self.frame_ms = elapsed
+        self.max_frame_ms = max(self.max_frame_ms, elapsed)
+        self.total_frame_ms += elapsed
+        self.frames += 1
+
+    async def run(self):
+        deadline = time.ticks_ms()
+        while True:
+            deadline = time.ticks_add(deadline, self.period_ms)
+            late = time.ticks_diff(time.ticks_ms(), deadline)
+            if late > 0:
+                # start again from now instead of drawing the lost frames in a burst
+                skipped = late // self.period_ms + 1
+                self.frames_skipped += skipped
+                deadline = time.ticks_add(deadline, skipped * self.period_ms)
+            await asyncio.sleep_ms(time.ticks_diff(deadline, time.ticks_ms()))
+            self.frame()
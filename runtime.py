@@ -0,0 +1,126 @@
+import asyncio
+import gc
+import time
+
+
+class LatencyMonitor:
+    """Measures how late the asyncio scheduler wakes up a sleeping task
+
+    A task that is late to wake up means some other task ran for too long
+    without yielding.
+    """
+
+    def __init__(self, period_ms: int = 100):
+        self.period_ms = period_ms
+        self.reset()
+
+    def reset(self):
+        self.last_ms = 0
+        self.max_ms = 0
+        self.total_ms = 0
+        self.samples = 0
+
+    @property
+    def average_ms(self) -> float:
+        return self.total_ms / self.samples if self.samples else 0
+
+    async def run(self):
+        while True:
+            start = time.ticks_ms()
+            await asyncio.sleep_ms(self.period_ms)
+            late = time.ticks_diff(time.ticks_ms(), start) - self.period_ms
+            self.last_ms = late
+            self.max_ms = max(self.max_ms, late)
+            self.total_ms += late
+            self.samples += 1
+
+
+class Runtime:
+    """Cooperative asyncio runtime for the info screen
+
+    Collects the tasks of the application, BLE event processing, periodic
+    jobs and buttons, and runs them together with idle time garbage
+    collection and a scheduler latency monitor. An exception in a job,
+    the BLE processing or a button handler is printed and the task goes on.
+    """
+
+    def __init__(self, gc_interval_ms: int = 5000):
+        self._tasks = []
+        self.gc_interval_ms = gc_interval_ms
+        self.gc_ms = 0
+        self.latency = LatencyMonitor()
+
+    def add(self, coro):
+        """Run a coroutine as a task once the runtime starts"""
+        self._tasks.append(coro)
+
+    def every(self, period_ms: int, func, *args):
+        """Call func(*args) every period_ms, the first call is one period after start"""
+        self.add(self._every(period_ms, func, args))
+
+    def ble(self, ble, connect_ms: int = 250):
+        """Decode the scan results queued by a GenericBLE in a task instead of micropython.schedule
+
+        Also drives its connections, checking every connect_ms for one to make.
+        """
+        flag = asyncio.ThreadSafeFlag()
+        ble.auto_process = False
+        ble.on_result = flag.set
+        self.add(self._ble(ble, flag))
+        self.every(connect_ms, ble.connections.tick)
+
+    def button(self, pin, handler, debounce_ms: int = 50):
+        """Call handler(pin) in a task when the pin falls"""
+        flag = asyncio.ThreadSafeFlag()
+        pin.irq(handler=lambda _: flag.set(), trigger=pin.IRQ_FALLING)
+        self.add(self._button(pin, handler, flag, debounce_ms))
+
+    def run(self, seconds: int):
+        """Run all tasks for the given number of seconds"""
+        asyncio.run(self._main(seconds))
+
+    async def _main(self, seconds: int):
+        for coro in self._tasks:
+            asyncio.create_task(coro)
+        asyncio.create_task(self.latency.run())
+        asyncio.create_task(self._gc())
+        await asyncio.sleep(seconds)
+
+    async def _every(self, period_ms: int, func, args):
+        deadline = time.ticks_ms()
+        while True:
+            deadline = time.ticks_add(deadline, period_ms)
+            await asyncio.sleep_ms(max(0, time.ticks_diff(deadline, time.ticks_ms())))
+            try:
+                func(*args)
+            except Exception as e:
+                # one failed call must not stop the job for the rest of the run
+                print(f"periodic {func} failed {e!r}")
+
+    async def _ble(self, ble, flag):
+        while True:
+            await flag.wait()
+            while True:
+                try:
+                    ble.process()
+                    break
+                except Exception as e:
+                    # a bad advertisement only loses itself, the rest of the queue is still decoded
+                    print(f"ble processing failed {e!r}")
+
+    async def _button(self, pin, handler, flag, debounce_ms: int):
+        while True:
+            await flag.wait()
+            await asyncio.sleep_ms(debounce_ms)
+            if not pin.value():
+                try:
+                    handler(pin)
+                except Exception as e:
+                    print(f"button handler failed {e!r}")
+
+    async def _gc(self):
+        while True:
+            await asyncio.sleep_ms(self.gc_interval_ms)
+            start = time.ticks_ms()
+            gc.collect()
+            self.gc_ms = time.ticks_diff(time.ticks_ms(), start)
@@ -37,6 +37,10 @@ This driver supports:
   BIOS text mode fonts.
 - Drawing text using converted TrueType fonts.
 - Drawing converted bitmaps
+- LRU cache of rendered glyphs
+- Batched SPI transactions that keep chip select asserted
+- Optional off-screen framebuffer that only sends changed regions to the
+  display
 - Named color constants
 
   - BLACK
@@ -79,6 +83,13 @@ except ImportError:
 #
 
 import struct
+from array import array
+from collections import OrderedDict
+
+try:
+    import framebuf
+except ImportError:
+    framebuf = None
 
 # ST7789 commands
 _ST7789_SWRESET = b"\x01"
@@ -137,6 +148,15 @@ _ENCODE_POS_16 = const("<HH")
 # must be at least 256 for 16 bit wide fonts
 _BUFFER_SIZE = const(256)
 
+# fill patterns kept for recently used colors
+_FILL_COLORS = const(4)
+
+# dirty rectangles kept before they are collapsed into their bounding box
+_MAX_DIRTY = const(8)
+
+# lines in the frame memory along the hardware scroll axis
+_FRAME_LINES = const(320)
+
 _BIT7 = const(0x80)
 _BIT6 = const(0x40)
 _BIT5 = const(0x20)
@@ -224,6 +244,117 @@ def color565(red, green=0, blue=0):
     return (red & 0xF8) << 8 | (green & 0xFC) << 3 | blue >> 3
 
 
+class GlyphCache:
+    """
+    Bounded LRU cache of rendered glyphs.
+
+    Glyphs are kept fully expanded to RGB565, ready to be sent to the display
+    or blitted into a framebuffer, so a cached character is drawn without
+    unpacking the font or allocating. The glyphs are filed in nested dicts by
+    font, fg_color, bg_color and character code, and each entry carries the
+    use count of its last hit, so neither a lookup nor a hit builds a key
+    or moves an entry. Evicting looks for the least recently used entry.
+
+    Args:
+        size (int): maximum number of bytes of glyph bitmaps to keep
+
+    Attributes:
+        used (int): bytes of glyph bitmaps currently cached
+        hits (int): lookups answered from the cache
+        misses (int): lookups that had to render the glyph
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._fonts = {}
+        self._uses = 0
+
+    def get(self, font, ch, fg_color, bg_color):
+        """
+        Return the cached glyph and mark it as most recently used, or None if
+        it is not cached.
+
+        Args:
+            font (module): font module of the glyph
+            ch (int): character code
+            fg_color (int): encoded color of the character
+            bg_color (int): encoded color of the background
+        """
+        entry = None
+        colors = self._fonts.get(font)
+        if colors is not None:
+            backgrounds = colors.get(fg_color)
+            if backgrounds is not None:
+                glyphs = backgrounds.get(bg_color)
+                if glyphs is not None:
+                    entry = glyphs.get(ch)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._uses += 1
+        entry[2] = self._uses
+        self.hits += 1
+        return entry[0]
+
+    def put(self, font, ch, fg_color, bg_color, glyph, nbytes):
+        """
+        Add a glyph to the cache, evicting the least recently used glyphs
+        until it fits in the budget.
+
+        Args:
+            font (module): font module of the glyph
+            ch (int): character code
+            fg_color (int): encoded color of the character
+            bg_color (int): encoded color of the background
+            glyph (tuple): the rendered glyph as returned by ST7789._glyph
+            nbytes (int): size of the glyph bitmap in bytes
+        """
+        if nbytes > self.size:
+            return
+
+        while self.used + nbytes > self.size:
+            self._evict()
+
+        colors = self._fonts.get(font)
+        if colors is None:
+            colors = self._fonts[font] = {}
+        backgrounds = colors.get(fg_color)
+        if backgrounds is None:
+            backgrounds = colors[fg_color] = {}
+        glyphs = backgrounds.get(bg_color)
+        if glyphs is None:
+            glyphs = backgrounds[bg_color] = {}
+        self._uses += 1
+        glyphs[ch] = [glyph, nbytes, self._uses]
+        self.used += nbytes
+
+    def _evict(self):
+        """
+        Drop the least recently used glyph.
+        """
+        oldest = None
+        for colors in self._fonts.values():
+            for backgrounds in colors.values():
+                for glyphs in backgrounds.values():
+                    for ch, entry in glyphs.items():
+                        if oldest is None or entry[2] < oldest[2][2]:
+                            oldest = (glyphs, ch, entry)
+        glyphs, ch, entry = oldest
+        del glyphs[ch]
+        self.used -= entry[1]
+
+    def clear(self):
+        """
+        Drop all cached glyphs. The hit and miss counters are kept.
+        """
+        self._fonts = {}
+        self.used = 0
+
+
 class ST7789:
     """
     ST7789 driver class
@@ -256,6 +387,34 @@ class ST7789:
 
           - ((width, height, xstart, ystart, madctl, needs_swap), ...)
 
+        buffered (bool): draw into an off-screen RGB565 framebuffer and only
+          send the changed regions to the display when show() is called.
+          Needs width * height * 2 bytes of RAM.
+
+        glyph_cache (int): number of bytes to use for caching rendered text
+          glyphs, 0 disables the cache. A 16x32 glyph needs 1024 bytes.
+
+        text_buffer (int): size in bytes of the buffer used to send a whole
+          line of text as a single window, 0 sends each character on its own.
+          A full 240 pixel wide line of a 16x32 font needs 15360 bytes.
+          Not used when buffered, text is then drawn into the framebuffer.
+
+        fill_chunk (int): number of pixels sent per SPI write by fill_rect.
+          A pattern of this size is kept for each of the last few colors
+          used, larger chunks make big fills faster at the cost of RAM.
+
+    Attributes:
+        transactions (int): number of times chip select was asserted
+        bytes_written (int): number of command and data bytes sent
+        windows (int): number of address windows set
+
+    The display can be used as a context manager to batch the SPI writes of
+    several drawing calls in one transaction::
+
+        with tft:
+            tft.fill_rect(0, 0, 10, 10, RED)
+            tft.text(font, "Hello", 0, 16)
+
     """
 
     def __init__(
@@ -271,6 +430,10 @@ class ST7789:
         color_order=BGR,
         custom_init=None,
         custom_rotations=None,
+        buffered=False,
+        glyph_cache=0,
+        text_buffer=0,
+        fill_chunk=_BUFFER_SIZE,
     ):
         """
         Initialize display.
@@ -299,6 +462,36 @@ class ST7789:
         self._rotation = rotation % 4
         self.color_order = color_order
         self.init_cmds = custom_init or _ST7789_INIT_CMDS
+        self.buffered = buffered
+        self._fb = None
+        self._fb_buf = None
+        self._dirty = []
+        self.glyph_cache = GlyphCache(glyph_cache) if glyph_cache else None
+        self._text_buf = bytearray(text_buffer) if text_buffer else None
+        # per converted true-type font {character: (first bit, width)}
+        self._fonts = {}
+        self._write_buf = None
+        # first bit, pixels, fg_color and bg_color for _expand
+        self._write_params = array("I", (0, 0, 0, 0))
+        # first byte, bytes, fg_color and bg_color for _pack
+        self._pack_params = array("I", (0, 0, 0, 0))
+        # ((width, height), buffer, glyph) reused while there is no glyph cache
+        self._glyph_scratch = None
+        self._fill_chunk = fill_chunk
+        self._fill_patterns = OrderedDict()
+        self._depth = 0
+        self._selected = False
+        self._dc_data = None
+        self._window_buf = bytearray(4)
+        self._window = [-1, -1, -1, -1]
+        self._madctl = 0
+        self._scroll_area = None
+        # first and last screen line of the scrolled area, show() leaves it alone
+        self._band = None
+        self.sleeping = False
+        self.transactions = 0
+        self.bytes_written = 0
+        self.windows = 0
         self.hard_reset()
         # yes, twice, once is not always enough
         self.init(self.init_cmds)
@@ -306,6 +499,7 @@ class ST7789:
         self.rotation(self._rotation)
         self.needs_swap = False
         self.fill(0x0)
+        self.show()
 
         if backlight is not None:
             backlight.value(1)
@@ -324,19 +518,56 @@ class ST7789:
         for command, data, delay in commands:
             self._write(command, data)
             sleep_ms(delay)
+        self._window = [-1, -1, -1, -1]
 
     def _write(self, command=None, data=None):
         """SPI write to the device: commands and data."""
-        if self.cs:
-            self.cs.off()
+        if not self._selected:
+            if self.cs:
+                self.cs.off()
+            self._selected = True
+            self.transactions += 1
         if command is not None:
-            self.dc.off()
+            if self._dc_data is not False:
+                self.dc.off()
+                self._dc_data = False
             self.spi.write(command)
+            self.bytes_written += len(command)
         if data is not None:
-            self.dc.on()
+            if self._dc_data is not True:
+                self.dc.on()
+                self._dc_data = True
             self.spi.write(data)
-            if self.cs:
-                self.cs.on()
+            self.bytes_written += len(data)
+        if not self._depth:
+            self._deselect()
+
+    def _deselect(self):
+        if self.cs:
+            self.cs.on()
+        self._selected = False
+
+    def begin(self):
+        """
+        Start a batch of SPI writes. Chip select is asserted on the first
+        write and held until the matching end(). Batches can be nested.
+        """
+        self._depth += 1
+
+    def end(self):
+        """
+        End a batch of SPI writes started with begin().
+        """
+        self._depth -= 1
+        if not self._depth and self._selected:
+            self._deselect()
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end()
 
     def hard_reset(self):
         """
@@ -355,6 +586,8 @@ class ST7789:
         sleep_ms(120)
         if self.cs:
             self.cs.on()
+        self._selected = False
+        self._window = [-1, -1, -1, -1]
 
     def soft_reset(self):
         """
@@ -362,19 +595,31 @@ class ST7789:
         """
         self._write(_ST7789_SWRESET)
         sleep_ms(150)
+        self._window = [-1, -1, -1, -1]
 
     def sleep_mode(self, value):
         """
         Enable or disable display sleep mode.
 
+        The panel is switched off before it goes to sleep and keeps its
+        memory. While it sleeps show() sends nothing, the changed regions of
+        the framebuffer are collected and sent in one go on waking up.
+
         Args:
             value (bool): if True enable sleep mode. if False disable sleep
             mode
         """
         if value:
+            self._write(_ST7789_DISPOFF)
             self._write(_ST7789_SLPIN)
+            self.sleeping = True
         else:
             self._write(_ST7789_SLPOUT)
+            # the supply voltages settle within 5 ms
+            sleep_ms(5)
+            self._write(_ST7789_DISPON)
+            self.sleeping = False
+            self.show()
 
     def inversion_mode(self, value):
         """
@@ -419,6 +664,128 @@ class ST7789:
             madctl &= ~_ST7789_MADCTL_BGR
 
         self._write(_ST7789_MADCTL, bytes([madctl]))
+        self._madctl = madctl
+        self._scroll_area = None
+        self._band = None
+        self._window = [-1, -1, -1, -1]
+        # patterns are stored in the byte order of the old rotation
+        self._fill_patterns = OrderedDict()
+        if self.buffered:
+            self._init_framebuffer()
+
+    def _init_framebuffer(self):
+        """
+        (Re)create the off-screen framebuffer for the current rotation.
+        """
+        size = self.width * self.height * 2
+        if self._fb_buf is None or len(self._fb_buf) != size:
+            self._fb_buf = bytearray(size)
+        self._fb = framebuf.FrameBuffer(
+            self._fb_buf, self.width, self.height, framebuf.RGB565
+        )
+        self._dirty = []
+        self._mark_dirty(0, 0, self.width, self.height)
+
+    def _encode_color(self, color):
+        """
+        Return the 16 bit value that stores color in a buffer in the byte
+        order the display expects.
+        """
+        return color if self.needs_swap else ((color << 8) & 0xFF00) | (color >> 8)
+
+    def _mark_dirty(self, x, y, width, height):
+        """
+        Add a region to the list of framebuffer regions that need to be sent
+        to the display. Overlapping or touching regions are merged.
+
+        Args:
+            x (int): Top left corner x coordinate
+            y (int): Top left corner y coordinate
+            width (int): Width in pixels
+            height (int): Height in pixels
+        """
+        x0 = max(x, 0)
+        y0 = max(y, 0)
+        x1 = min(x + width, self.width) - 1
+        y1 = min(y + height, self.height) - 1
+        if x0 > x1 or y0 > y1:
+            return
+
+        dirty = self._dirty
+        i = 0
+        while i < len(dirty):
+            dx0, dy0, dx1, dy1 = dirty[i]
+            if x0 <= dx1 + 1 and dx0 <= x1 + 1 and y0 <= dy1 + 1 and dy0 <= y1 + 1:
+                # the grown region may now touch one we already checked
+                x0 = min(x0, dx0)
+                y0 = min(y0, dy0)
+                x1 = max(x1, dx1)
+                y1 = max(y1, dy1)
+                dirty.pop(i)
+                i = 0
+            else:
+                i += 1
+
+        dirty.append((x0, y0, x1, y1))
+        if len(dirty) > _MAX_DIRTY:
+            x0 = min(r[0] for r in dirty)
+            y0 = min(r[1] for r in dirty)
+            x1 = max(r[2] for r in dirty)
+            y1 = max(r[3] for r in dirty)
+            self._dirty = [(x0, y0, x1, y1)]
+
+    def show(self):
+        """
+        Send the changed regions of the framebuffer to the display. Each
+        region is sent as a single window. Does nothing when the display is
+        not buffered or while the display sleeps.
+        """
+        if self._fb is None or self.sleeping:
+            return
+
+        buffer = memoryview(self._fb_buf)
+        stride = self.width * 2
+        self.begin()
+        for region in self._dirty:
+            for x0, y0, x1, y1 in self._clip_band(*region):
+                self._set_window(x0, y0, x1, y1)
+                if x0 == 0 and x1 == self.width - 1:
+                    self._write(None, buffer[y0 * stride : (y1 + 1) * stride])
+                else:
+                    start = y0 * stride + x0 * 2
+                    end = start + (x1 - x0 + 1) * 2
+                    for _ in range(y1 - y0 + 1):
+                        self._write(None, buffer[start:end])
+                        start += stride
+                        end += stride
+
+        self.end()
+        self._dirty = []
+
+    def _clip_band(self, x0, y0, x1, y1):
+        """
+        Return the parts of a region outside the hardware scrolled area. The
+        area is only drawn with blit_panel, the framebuffer holds nothing
+        current there and its pixels would land on scrolled addresses.
+        """
+        band = self._band
+        if band is None:
+            return ((x0, y0, x1, y1),)
+
+        first, last = band
+        scrolls_x = self.scrolls_x
+        low, high = (x0, x1) if scrolls_x else (y0, y1)
+        if high < first or low > last:
+            return ((x0, y0, x1, y1),)
+
+        parts = []
+        for low, high in ((low, min(high, first - 1)), (max(low, last + 1), high)):
+            if low <= high:
+                if scrolls_x:
+                    parts.append((low, y0, high, y1))
+                else:
+                    parts.append((x0, low, x1, high))
+        return parts
 
     def _set_window(self, x0, y0, x1, y1):
         """
@@ -431,15 +798,27 @@ class ST7789:
             y1 (int): row end address
         """
         if x0 <= x1 <= self.width and y0 <= y1 <= self.height:
-            self._write(
-                _ST7789_CASET,
-                struct.pack(_ENCODE_POS, x0 + self.xstart, x1 + self.xstart),
-            )
-            self._write(
-                _ST7789_RASET,
-                struct.pack(_ENCODE_POS, y0 + self.ystart, y1 + self.ystart),
-            )
+            # the controller keeps the address window, so only send what changed
+            window = self._window
+            buffer = self._window_buf
+            x0 += self.xstart
+            x1 += self.xstart
+            y0 += self.ystart
+            y1 += self.ystart
+            self.begin()
+            if window[0] != x0 or window[1] != x1:
+                struct.pack_into(_ENCODE_POS, buffer, 0, x0, x1)
+                self._write(_ST7789_CASET, buffer)
+                window[0] = x0
+                window[1] = x1
+            if window[2] != y0 or window[3] != y1:
+                struct.pack_into(_ENCODE_POS, buffer, 0, y0, y1)
+                self._write(_ST7789_RASET, buffer)
+                window[2] = y0
+                window[3] = y1
             self._write(_ST7789_RAMWR)
+            self.end()
+            self.windows += 1
 
     def vline(self, x, y, length, color):
         """
@@ -474,6 +853,12 @@ class ST7789:
             Y (int): y coordinate
             color (int): 565 encoded color
         """
+        if self._fb is not None:
+            self._fb.pixel(x, y, self._encode_color(color))
+            self._mark_dirty(x, y, 1, 1)
+            return
+
+        self.begin()
         self._set_window(x, y, x, y)
         self._write(
             None,
@@ -481,6 +866,7 @@ class ST7789:
                 _ENCODE_PIXEL_SWAPPED if self.needs_swap else _ENCODE_PIXEL, color
             ),
         )
+        self.end()
 
     def blit_buffer(self, buffer, x, y, width, height):
         """
@@ -492,9 +878,40 @@ class ST7789:
             Y (int): Top left corner y coordinate
             width (int): Width
             height (int): Height
+
+        The buffer may also be a RGB565 FrameBuffer of the given size.
+        """
+        if self._fb is not None:
+            if not isinstance(buffer, framebuf.FrameBuffer):
+                if not isinstance(buffer, (bytearray, memoryview)):
+                    buffer = bytearray(buffer)
+                buffer = framebuf.FrameBuffer(buffer, width, height, framebuf.RGB565)
+            self._fb.blit(buffer, x, y)
+            self._mark_dirty(x, y, width, height)
+            return
+
+        self.blit_panel(buffer, x, y, width, height)
+
+    def blit_panel(self, buffer, x, y, width, height):
         """
+        Copy buffer straight to the display memory, also when the display is
+        buffered. The framebuffer is not updated, so this is meant for areas
+        that are only drawn this way, like a hardware scrolled area.
+
+        Args:
+            buffer (bytes): Data to copy to display
+            x (int): Top left corner x coordinate
+            Y (int): Top left corner y coordinate
+            width (int): Width
+            height (int): Height
+        """
+        if framebuf is not None and isinstance(buffer, framebuf.FrameBuffer):
+            # SPI takes its buffer, but it has no len() to count the bytes
+            buffer = memoryview(buffer)
+        self.begin()
         self._set_window(x, y, x + width - 1, y + height - 1)
         self._write(None, buffer)
+        self.end()
 
     def rect(self, x, y, w, h, color):
         """
@@ -507,10 +924,11 @@ class ST7789:
             height (int): Height in pixels
             color (int): 565 encoded color
         """
-        self.hline(x, y, w, color)
-        self.vline(x, y, h, color)
-        self.vline(x + w - 1, y, h, color)
-        self.hline(x, y + h - 1, w, color)
+        with self:
+            self.hline(x, y, w, color)
+            self.vline(x, y, h, color)
+            self.vline(x + w - 1, y, h, color)
+            self.hline(x, y + h - 1, w, color)
 
     def fill_rect(self, x, y, width, height, color):
         """
@@ -523,18 +941,51 @@ class ST7789:
             height (int): Height in pixels
             color (int): 565 encoded color
         """
+        if self._fb is not None:
+            self._fb.fill_rect(x, y, width, height, self._encode_color(color))
+            self._mark_dirty(x, y, width, height)
+            return
+
+        self.begin()
         self._set_window(x, y, x + width - 1, y + height - 1)
-        chunks, rest = divmod(width * height, _BUFFER_SIZE)
-        pixel = struct.pack(
-            _ENCODE_PIXEL_SWAPPED if self.needs_swap else _ENCODE_PIXEL, color
-        )
-        self.dc.on()
-        if chunks:
-            data = pixel * _BUFFER_SIZE
-            for _ in range(chunks):
-                self._write(None, data)
+        chunks, rest = divmod(width * height, self._fill_chunk)
+        pattern = self._fill_pattern(color)
+        for _ in range(chunks):
+            self._write(None, pattern)
         if rest:
-            self._write(None, pixel * rest)
+            self._write(None, pattern[: rest * 2])
+        self.end()
+
+    def _fill_pattern(self, color):
+        """
+        Return a memoryview of fill_chunk pixels of color, reusing the
+        pattern of a recently used color.
+
+        Args:
+            color (int): 565 encoded color
+        """
+        patterns = self._fill_patterns
+        pattern = patterns.pop(color, None)
+        if pattern is None:
+            if len(patterns) >= _FILL_COLORS:
+                pattern = patterns.pop(next(iter(patterns)))
+            else:
+                pattern = memoryview(bytearray(self._fill_chunk * 2))
+            struct.pack_into(
+                _ENCODE_PIXEL_SWAPPED if self.needs_swap else _ENCODE_PIXEL,
+                pattern,
+                0,
+                color,
+            )
+            filled = 2
+            size = len(pattern)
+            while filled < size:
+                count = min(filled, size - filled)
+                pattern[filled : filled + count] = pattern[:count]
+                filled += count
+
+        patterns[color] = pattern
+        return pattern
 
     def fill(self, color):
         """
@@ -556,6 +1007,14 @@ class ST7789:
             y1 (int): End point y coordinate
             color (int): 565 encoded color
         """
+        if self._fb is not None:
+            self._fb.line(x0, y0, x1, y1, self._encode_color(color))
+            self._mark_dirty(
+                min(x0, x1), min(y0, y1), abs(x1 - x0) + 1, abs(y1 - y0) + 1
+            )
+            return
+
+        self.begin()
         steep = abs(y1 - y0) > abs(x1 - x0)
         if steep:
             x0, y0 = y0, x0
@@ -577,6 +1036,7 @@ class ST7789:
                 y0 += ystep
                 err += dx
             x0 += 1
+        self.end()
 
     def vscrdef(self, tfa, vsa, bfa):
         """
@@ -614,14 +1074,77 @@ class ST7789:
         """
         self._write(_ST7789_VSCSAD, struct.pack(">H", vssa))
 
+    @property
+    def scrolls_x(self):
+        """
+        True when hardware scrolling moves the picture along x, which is the
+        case in landscape rotations, False when it moves along y.
+        """
+        return bool(self._madctl & _ST7789_MADCTL_MV)
+
+    def scroll_area(self, start, length):
+        """
+        Define the hardware scrolled area in screen coordinates, without
+        having to know how the rotation maps them on the frame memory.
+
+        The area is length lines from start along the scroll axis, x in
+        landscape and y in portrait rotations, and always covers the full
+        screen along the other axis. Everything outside the area stays
+        fixed. Changing the rotation ends scrolling. The area is left out
+        when show() sends the framebuffer, draw it with blit_panel.
+
+        Args:
+            start (int): first column (landscape) or row (portrait)
+            length (int): number of columns or rows
+        """
+        if self.scrolls_x:
+            first = start + self.xstart
+        else:
+            first = start + self.ystart
+        if self._madctl & _ST7789_MADCTL_MY:
+            # frame memory lines run the other way
+            first = _FRAME_LINES - first - length
+        self._scroll_area = (first, length)
+        self._band = (start, start + length - 1)
+        self.vscrdef(first, length, _FRAME_LINES - first - length)
+        self.scroll(0)
+
+    def scroll(self, offset):
+        """
+        Scroll the area defined with scroll_area by offset lines. What was
+        drawn at start + offset is shown at start, lines scrolled out at the
+        start come back in at the end.
+
+        Args:
+            offset (int): lines to scroll, taken modulo the area length
+        """
+        first, length = self._scroll_area
+        offset %= length
+        if self._madctl & _ST7789_MADCTL_MY:
+            offset = (length - offset) % length
+        self.vscsad(first + offset)
+
     @micropython.viper
     @staticmethod
-    def _pack8(glyphs, idx: uint, fg_color: uint, bg_color: uint):
-        buffer = bytearray(128)
-        bitmap = ptr16(buffer)
-        glyph = ptr8(glyphs)
+    def _pack(glyphs, buffer, params):
+        """
+        Expand the rows of a bitmap font glyph into RGB565 pixels.
 
-        for i in range(0, 64, 8):
+        Args:
+            glyphs (bytes): font.FONT
+            buffer (bytearray): receives the pixels
+            params (array): first byte, number of bytes, encoded fg_color
+                and bg_color
+        """
+        glyph = ptr8(glyphs)
+        bitmap = ptr16(buffer)
+        args = ptr32(params)
+        idx = int(args[0])
+        end = idx + int(args[1])
+        fg_color = int(args[2])
+        bg_color = int(args[3])
+        i = 0
+        while idx < end:
             byte = glyph[idx]
             bitmap[i] = fg_color if byte & _BIT7 else bg_color
             bitmap[i + 1] = fg_color if byte & _BIT6 else bg_color
@@ -631,52 +1154,67 @@ class ST7789:
             bitmap[i + 5] = fg_color if byte & _BIT2 else bg_color
             bitmap[i + 6] = fg_color if byte & _BIT1 else bg_color
             bitmap[i + 7] = fg_color if byte & _BIT0 else bg_color
+            i += 8
             idx += 1
 
-        return buffer
-
-    @micropython.viper
-    @staticmethod
-    def _pack16(glyphs, idx: uint, fg_color: uint, bg_color: uint):
+    def _glyph(self, font, ch, fg_color, bg_color):
         """
-        Pack a character into a byte array.
+        Return the character rendered in RGB565, from the glyph cache when
+        possible.
 
         Args:
-            char (str): character to pack
+            font (module): font module to use
+            ch (int): character code, must be in the font
+            fg_color (int): encoded color to use for the character
+            bg_color (int): encoded color to use for the background
 
         Returns:
-            128 bytes: character bitmap in color565 format
+            tuple: (buffer, glyph), the font.WIDTH x font.HEIGHT bitmap and a
+            FrameBuffer over it when framebuf is available, else buffer again
         """
+        cache = self.glyph_cache
+        if cache is not None:
+            entry = cache.get(font, ch, fg_color, bg_color)
+            if entry is not None:
+                return entry
+
+        nbytes = font.WIDTH * font.HEIGHT * 2
+        if cache is None:
+            # without a cache every glyph is rendered into the same buffer
+            scratch = self._glyph_scratch
+            if scratch is None or scratch[0] != (font.WIDTH, font.HEIGHT):
+                scratch = ((font.WIDTH, font.HEIGHT),) + self._new_glyph(
+                    font.WIDTH, font.HEIGHT
+                )
+                self._glyph_scratch = scratch
+            _, buffer, glyph = scratch
+        else:
+            buffer, glyph = self._new_glyph(font.WIDTH, font.HEIGHT)
 
-        buffer = bytearray(256)
-        bitmap = ptr16(buffer)
-        glyph = ptr8(glyphs)
+        # the font stores the rows of a glyph one after the other, msb left
+        row_bytes = font.WIDTH // 8
+        params = self._pack_params
+        params[0] = (ch - font.FIRST) * row_bytes * font.HEIGHT
+        params[1] = row_bytes * font.HEIGHT
+        params[2] = fg_color
+        params[3] = bg_color
+        self._pack(font.FONT, buffer, params)
 
-        for i in range(0, 128, 16):
-            byte = glyph[idx]
+        if cache is not None:
+            cache.put(font, ch, fg_color, bg_color, (buffer, glyph), nbytes)
+        return buffer, glyph
 
-            bitmap[i] = fg_color if byte & _BIT7 else bg_color
-            bitmap[i + 1] = fg_color if byte & _BIT6 else bg_color
-            bitmap[i + 2] = fg_color if byte & _BIT5 else bg_color
-            bitmap[i + 3] = fg_color if byte & _BIT4 else bg_color
-            bitmap[i + 4] = fg_color if byte & _BIT3 else bg_color
-            bitmap[i + 5] = fg_color if byte & _BIT2 else bg_color
-            bitmap[i + 6] = fg_color if byte & _BIT1 else bg_color
-            bitmap[i + 7] = fg_color if byte & _BIT0 else bg_color
-            idx += 1
-
-            byte = glyph[idx]
-            bitmap[i + 8] = fg_color if byte & _BIT7 else bg_color
-            bitmap[i + 9] = fg_color if byte & _BIT6 else bg_color
-            bitmap[i + 10] = fg_color if byte & _BIT5 else bg_color
-            bitmap[i + 11] = fg_color if byte & _BIT4 else bg_color
-            bitmap[i + 12] = fg_color if byte & _BIT3 else bg_color
-            bitmap[i + 13] = fg_color if byte & _BIT2 else bg_color
-            bitmap[i + 14] = fg_color if byte & _BIT1 else bg_color
-            bitmap[i + 15] = fg_color if byte & _BIT0 else bg_color
-            idx += 1
-
-        return buffer
+    @staticmethod
+    def _new_glyph(width, height):
+        """
+        Return (buffer, glyph) for a new width x height glyph bitmap, glyph
+        is a FrameBuffer over buffer when framebuf is available.
+        """
+        buffer = bytearray(width * height * 2)
+        glyph = buffer
+        if framebuf is not None:
+            glyph = framebuf.FrameBuffer(buffer, width, height, framebuf.RGB565)
+        return buffer, glyph
 
     def _text8(self, font, text, x0, y0, fg_color=WHITE, bg_color=BLACK):
         """
@@ -699,20 +1237,11 @@ class ST7789:
                 and x0 + font.WIDTH <= self.width
                 and y0 + font.HEIGHT <= self.height
             ):
-                if font.HEIGHT == 8:
-                    passes = 1
-                    size = 8
-                    each = 0
-                else:
-                    passes = 2
-                    size = 16
-                    each = 8
-
-                for line in range(passes):
-                    idx = (ch - font.FIRST) * size + (each * line)
-                    buffer = self._pack8(font.FONT, idx, fg_color, bg_color)
-                    self.blit_buffer(buffer, x0, y0 + 8 * line, 8, 8)
-
+                buffer, glyph = self._glyph(font, ch, fg_color, bg_color)
+                # the panel needs the bytes, the framebuffer blits fastest from a FrameBuffer
+                self.blit_buffer(
+                    buffer if self._fb is None else glyph, x0, y0, 8, font.HEIGHT
+                )
                 x0 += 8
 
     def _text16(self, font, text, x0, y0, fg_color=WHITE, bg_color=BLACK):
@@ -736,20 +1265,83 @@ class ST7789:
                 and x0 + font.WIDTH <= self.width
                 and y0 + font.HEIGHT <= self.height
             ):
-                each = 16
-                if font.HEIGHT == 16:
-                    passes = 2
-                    size = 32
-                else:
-                    passes = 4
-                    size = 64
-
-                for line in range(passes):
-                    idx = (ch - font.FIRST) * size + (each * line)
-                    buffer = self._pack16(font.FONT, idx, fg_color, bg_color)
-                    self.blit_buffer(buffer, x0, y0 + 8 * line, 16, 8)
+                buffer, glyph = self._glyph(font, ch, fg_color, bg_color)
+                self.blit_buffer(
+                    buffer if self._fb is None else glyph, x0, y0, 16, font.HEIGHT
+                )
             x0 += 16
 
+    def _text_line(self, font, text, x0, y0, fg_color, bg_color):
+        """
+        Internal method to draw a string as runs of adjacent characters, each
+        composed in the text buffer and sent as a single window.
+
+        Args:
+            font (module): font module to use
+            text (str): text to write
+            x0 (int): column to start drawing at
+            y0 (int): row to start drawing at
+            fg_color (int): encoded color to use for characters
+            bg_color (int): encoded color to use for background
+        """
+        if y0 + font.HEIGHT > self.height:
+            return
+
+        width = font.WIDTH
+        run = []
+        for char in text:
+            if x0 + width * (len(run) + 1) > self.width:
+                break
+            ch = ord(char)
+            if font.FIRST <= ch < font.LAST:
+                run.append(ch)
+            elif width == 16:
+                # 16 bit wide fonts leave the cell of a missing character alone
+                self._text_run(font, run, x0, y0, fg_color, bg_color)
+                x0 += width * (len(run) + 1)
+                run = []
+
+        self._text_run(font, run, x0, y0, fg_color, bg_color)
+
+    def _text_run(self, font, run, x0, y0, fg_color, bg_color):
+        """
+        Internal method to send adjacent characters in as few windows as the
+        text buffer allows.
+
+        Args:
+            font (module): font module to use
+            run (list): character codes to draw
+            x0 (int): column to start drawing at
+            y0 (int): row to start drawing at
+            fg_color (int): encoded color to use for characters
+            bg_color (int): encoded color to use for background
+        """
+        width = font.WIDTH
+        height = font.HEIGHT
+        buffer = self._text_buf
+        per_band = len(buffer) // (width * height * 2)
+        if not per_band:
+            for ch in run:
+                glyph, _ = self._glyph(font, ch, fg_color, bg_color)
+                self.blit_buffer(glyph, x0, y0, width, height)
+                x0 += width
+            return
+
+        count = len(run)
+        self.begin()
+        for start in range(0, count, per_band):
+            chars = min(per_band, count - start)
+            band_width = chars * width
+            band = framebuf.FrameBuffer(buffer, band_width, height, framebuf.RGB565)
+            for i in range(chars):
+                _, glyph = self._glyph(font, run[start + i], fg_color, bg_color)
+                band.blit(glyph, i * width, 0)
+
+            self._set_window(x0, y0, x0 + band_width - 1, y0 + height - 1)
+            self._write(None, memoryview(buffer)[: band_width * height * 2])
+            x0 += band_width
+        self.end()
+
     def text(self, font, text, x0, y0, color=WHITE, background=BLACK):
         """
         Draw text on display in specified font and colors. 8 and 16 bit wide
@@ -763,17 +1355,17 @@ class ST7789:
             color (int): 565 encoded color to use for characters
             background (int): 565 encoded color to use for background
         """
-        fg_color = color if self.needs_swap else ((color << 8) & 0xFF00) | (color >> 8)
-        bg_color = (
-            background
-            if self.needs_swap
-            else ((background << 8) & 0xFF00) | (background >> 8)
-        )
+        fg_color = self._encode_color(color)
+        bg_color = self._encode_color(background)
 
-        if font.WIDTH == 8:
+        self.begin()
+        if self._text_buf is not None and self._fb is None and framebuf is not None:
+            self._text_line(font, text, x0, y0, fg_color, bg_color)
+        elif font.WIDTH == 8:
             self._text8(font, text, x0, y0, fg_color, bg_color)
         else:
             self._text16(font, text, x0, y0, fg_color, bg_color)
+        self.end()
 
     def bitmap(self, bitmap, x, y, index=0):
         """
@@ -817,8 +1409,7 @@ class ST7789:
                 buffer[i] = color >> 8
                 buffer[i + 1] = color & 0xFF
 
-        self._set_window(x, y, to_col, to_row)
-        self._write(None, buffer)
+        self.blit_buffer(buffer, x, y, width, height)
 
     def pbitmap(self, bitmap, x, y, index=0):
         """
@@ -841,6 +1432,7 @@ class ST7789:
         needs_swap = self.needs_swap
         buffer = bytearray(bitmap.WIDTH * 2)
 
+        self.begin()
         for row in range(height):
             for col in range(width):
                 color_index = 0
@@ -861,8 +1453,60 @@ class ST7789:
             to_col = x + width - 1
             to_row = y + row
             if self.width > to_col and self.height > to_row:
-                self._set_window(x, y + row, to_col, to_row)
-                self._write(None, buffer)
+                self.blit_buffer(buffer, x, to_row, width, 1)
+        self.end()
+
+    @micropython.viper
+    @staticmethod
+    def _expand(bitmaps, buffer, params):
+        """
+        Expand the bits of a converted true-type font glyph into RGB565
+        pixels.
+
+        Args:
+            bitmaps (bytes): font.BITMAPS
+            buffer (bytearray): receives the pixels
+            params (array): first bit, number of pixels, encoded fg_color
+                and bg_color
+        """
+        source = ptr8(bitmaps)
+        pixels = ptr16(buffer)
+        args = ptr32(params)
+        bit = int(args[0])
+        count = int(args[1])
+        fg_color = int(args[2])
+        bg_color = int(args[3])
+        for i in range(count):
+            if source[bit >> 3] & (0x80 >> (bit & 7)):
+                pixels[i] = fg_color
+            else:
+                pixels[i] = bg_color
+            bit += 1
+
+    def load_font(self, font):
+        """
+        Index a converted true-type font for write and write_width. Done
+        once per font on its first use, so calling it beforehand only moves
+        the work.
+
+        Args:
+            font (font): The module containing the converted true-type font
+
+        Returns:
+            dict: {character: (first bit, width)}
+        """
+        index = self._fonts.get(font)
+        if index is None:
+            index = {}
+            offsets = font.OFFSETS
+            step = font.OFFSET_WIDTH
+            for char_index, character in enumerate(font.MAP):
+                bs_bit = 0
+                for offset in range(char_index * step, (char_index + 1) * step):
+                    bs_bit = (bs_bit << 8) + offsets[offset]
+                index[character] = (bs_bit, font.WIDTHS[char_index])
+            self._fonts[font] = index
+        return index
 
     def write(self, font, string, x, y, fg=WHITE, bg=BLACK):
         """
@@ -877,48 +1521,34 @@ class ST7789:
             fg (int): foreground color, optional, defaults to WHITE
             bg (int): background color, optional, defaults to BLACK
         """
-        buffer_len = font.HEIGHT * font.MAX_WIDTH * 2
-        buffer = bytearray(buffer_len)
-        fg_hi = fg >> 8
-        fg_lo = fg & 0xFF
-
-        bg_hi = bg >> 8
-        bg_lo = bg & 0xFF
-
+        index = self.load_font(font)
+        height = font.HEIGHT
+        buffer_len = height * font.MAX_WIDTH * 2
+        if self._write_buf is None or len(self._write_buf) < buffer_len:
+            self._write_buf = bytearray(buffer_len)
+        buffer = self._write_buf
+        view = memoryview(buffer)
+        bitmaps = font.BITMAPS
+        params = self._write_params
+        params[2] = self._encode_color(fg)
+        params[3] = self._encode_color(bg)
+
+        self.begin()
         for character in string:
-            try:
-                char_index = font.MAP.index(character)
-                offset = char_index * font.OFFSET_WIDTH
-                bs_bit = font.OFFSETS[offset]
-                if font.OFFSET_WIDTH > 1:
-                    bs_bit = (bs_bit << 8) + font.OFFSETS[offset + 1]
-
-                if font.OFFSET_WIDTH > 2:
-                    bs_bit = (bs_bit << 8) + font.OFFSETS[offset + 2]
-
-                char_width = font.WIDTHS[char_index]
-                buffer_needed = char_width * font.HEIGHT * 2
-
-                for i in range(0, buffer_needed, 2):
-                    if font.BITMAPS[bs_bit // 8] & 1 << (7 - (bs_bit % 8)) > 0:
-                        buffer[i] = fg_hi
-                        buffer[i + 1] = fg_lo
-                    else:
-                        buffer[i] = bg_hi
-                        buffer[i + 1] = bg_lo
-
-                    bs_bit += 1
-
-                to_col = x + char_width - 1
-                to_row = y + font.HEIGHT - 1
-                if self.width > to_col and self.height > to_row:
-                    self._set_window(x, y, to_col, to_row)
-                    self._write(None, buffer[:buffer_needed])
+            glyph = index.get(character)
+            if glyph is None:
+                continue
 
-                x += char_width
+            bs_bit, char_width = glyph
+            if self.width >= x + char_width and self.height >= y + height:
+                pixels = char_width * height
+                params[0] = bs_bit
+                params[1] = pixels
+                self._expand(bitmaps, buffer, params)
+                self.blit_buffer(view[: pixels * 2], x, y, char_width, height)
 
-            except ValueError:
-                pass
+            x += char_width
+        self.end()
 
     def write_width(self, font, string):
         """
@@ -933,13 +1563,12 @@ class ST7789:
             int: The width of the string in pixels
 
         """
+        index = self.load_font(font)
         width = 0
         for character in string:
-            try:
-                char_index = font.MAP.index(character)
-                width += font.WIDTHS[char_index]
-            except ValueError:
-                pass
+            glyph = index.get(character)
+            if glyph is not None:
+                width += glyph[1]
 
         return width
 
@@ -984,6 +1613,7 @@ class ST7789:
         else:
             rotated = [(x + int((point[0])), y + int((point[1]))) for point in points]
 
+        self.begin()
         for i in range(1, len(rotated)):
             self.line(
                 rotated[i - 1][0],
@@ -992,3 +1622,4 @@ class ST7789:
                 rotated[i][1],
                 color,
             )
+        self.end()
@@ -0,0 +1,65 @@
+from array import array
+from st7789py import WHITE, BLACK
+
+
+class TextGrid:
+    """Character cell text layer on a ST7789 for fixed pitch fonts
+
+    Remembers the character and colors shown in every cell and only sends the
+    cells that differ, adjacent changed cells are drawn with one text call.
+    """
+
+    def __init__(self, display, font, x: int, y: int, columns: int, rows: int = 1):
+        self._display = display
+        self._font = font
+        self._x = x
+        self._y = y
+        self.columns = columns
+        self.rows = rows
+        cells = columns * rows
+        self._chars = array("H", bytes(2 * cells))
+        self._fg = array("H", bytes(2 * cells))
+        self._bg = array("H", bytes(2 * cells))
+        self.cells_drawn = 0
+
+    def invalidate(self):
+        """Forget what is shown so the next text call redraws every cell"""
+        for i in range(len(self._chars)):
+            self._chars[i] = 0
+
+    def text(self, text: str, column: int = 0, row: int = 0, fg=WHITE, bg=BLACK):
+        """Show text starting at the given cell, text past the end of the row is cut"""
+        chars = self._chars
+        fgs = self._fg
+        bgs = self._bg
+        cell = row * self.columns + column
+        count = min(len(text), self.columns - column)
+        start = -1
+        for i in range(count + 1):
+            changed = False
+            if i < count:
+                ch = ord(text[i])
+                if chars[cell] != ch or fgs[cell] != fg or bgs[cell] != bg:
+                    chars[cell] = ch
+                    fgs[cell] = fg
+                    bgs[cell] = bg
+                    changed = True
+                cell += 1
+            if changed:
+                if start < 0:
+                    start = i
+            elif start >= 0:
+                self._draw(text[start:i], column + start, row, fg, bg)
+                start = -1
+
+    def _draw(self, text: str, column: int, row: int, fg, bg):
+        font = self._font
+        self._display.text(
+            font,
+            text,
+            self._x + column * font.WIDTH,
+            self._y + row * font.HEIGHT,
+            fg,
+            bg,
+        )
+        self.cells_drawn += len(text)